@@ -0,0 +1,270 @@
+import asyncio
+import json
+import logging
+import uuid
+from collections import deque
+from typing import (
+    Any, Awaitable, Callable, Deque, Dict, List, Optional, Set
+)
+
+import aioredis
+
+logger = logging.getLogger(__file__)
+
+
+class BackgroundTaskQueue:
+    """Bounded in-process queue for fire-and-forget side effects.
+
+    Handlers submit a registered task by name and do not wait for it.
+    ``workers`` coroutines run the tasks; a failed task is retried with
+    exponential backoff and, after ``max_attempts``, moved to the dead
+    letters. When ``redis`` is given, queued tasks are also kept in the
+    Redis list ``<key_prefix>:processing:<instance id>`` of this process,
+    and the process refreshes its ``<key_prefix>:heartbeat:<instance id>``
+    key every ``heartbeat_ttl / 3`` seconds. On :meth:`start` and then on
+    every heartbeat, tasks of instances whose heartbeat has expired are
+    moved one by one with RPOPLPUSH into the own list and run. Tasks of live
+    replicas are never taken. Task arguments have to be JSON
+    serializable.
+    """
+
+    def __init__(self, maxsize: int = 1000, workers: int = 4,
+                 max_attempts: int = 3, retry_delay: float = 1,
+                 redis: aioredis.Redis = None, key_prefix: str = 'tasks',
+                 dead_letters_limit: int = 1000, heartbeat_ttl: int = 60):
+        self.maxsize = maxsize
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.redis = redis
+        self.key_prefix = key_prefix
+        self.instance_id = uuid.uuid4().hex
+        self.heartbeat_ttl = heartbeat_ttl
+        self.instances_key = f'{key_prefix}:instances'
+        self.processing_key = self._get_processing_key(self.instance_id)
+        self.heartbeat_key = self._get_heartbeat_key(self.instance_id)
+        self.dead_letters_key = f'{key_prefix}:dead'
+        self.dead_letters_limit = dead_letters_limit
+        self.dead_letters: Deque[Dict[str, Any]] = deque(
+            maxlen=dead_letters_limit
+        )
+        self.completed = 0
+        self.failed = 0
+        self.dropped = 0
+        self._handlers: Dict[str, Callable[..., Awaitable[Any]]] = {}
+        self._queue: 'asyncio.Queue[Dict[str, Any]]' = asyncio.Queue()
+        self._workers: List[asyncio.Task] = []
+        self._retries: Set[asyncio.Task] = set()
+        self._heartbeat: Optional[asyncio.Task] = None
+        self._accepting = False
+
+    def _get_processing_key(self, instance_id: str) -> str:
+        return f'{self.key_prefix}:processing:{instance_id}'
+
+    def _get_heartbeat_key(self, instance_id: str) -> str:
+        return f'{self.key_prefix}:heartbeat:{instance_id}'
+
+    def register(self, name: str,
+                 handler: Callable[..., Awaitable[Any]]) -> None:
+        self._handlers[name] = handler
+
+    async def _redis_call(self, method: str, *args: Any) -> Any:
+        if not self.redis:
+            return None
+        try:
+            return await getattr(self.redis, method)(*args)
+        except aioredis.RedisError as err:
+            logger.error(f'Ошибка Redis в очереди задач: {err}')
+            return None
+
+    async def submit(self, name: str, *args: Any, **kwargs: Any) -> bool:
+        if name not in self._handlers:
+            raise KeyError(f'Unknown task {name}')
+        if not self._accepting or self._queue.qsize() >= self.maxsize:
+            self.dropped += 1
+            logger.warning(f'Задача {name} отброшена: очередь недоступна '
+                           f'или переполнена')
+            return False
+
+        task = {
+            'id': uuid.uuid4().hex,
+            'name': name,
+            'args': list(args),
+            'kwargs': kwargs,
+        }
+        task['raw'] = json.dumps(task)
+        task['attempts'] = 0
+        await self._redis_call('lpush', self.processing_key, task['raw'])
+        self._queue.put_nowait(task)
+        return True
+
+    async def _enqueue_raw(self, raw_task: bytes) -> None:
+        try:
+            task = json.loads(raw_task)
+        except ValueError:
+            await self._redis_call('lrem', self.processing_key, 1, raw_task)
+            return
+        task['raw'] = raw_task
+        task['attempts'] = 0
+        self._queue.put_nowait(task)
+
+    async def _adopt(self, source_key: str) -> int:
+        adopted = 0
+        while True:
+            raw_task = await self.redis.rpoplpush(source_key,
+                                                  self.processing_key)
+            if raw_task is None:
+                return adopted
+            await self._enqueue_raw(raw_task)
+            adopted += 1
+
+    async def _register_instance(self) -> None:
+        await self._redis_call('sadd', self.instances_key, self.instance_id)
+        await self._redis_call('set', self.heartbeat_key, 1,
+                               self.heartbeat_ttl)
+
+    async def _adopt_orphans(self) -> None:
+        """Takes over the tasks of instances that stopped refreshing their
+        heartbeat."""
+        if not self.redis:
+            return
+        adopted = 0
+        try:
+            for instance_id in await self.redis.smembers(self.instances_key):
+                if isinstance(instance_id, bytes):
+                    instance_id = instance_id.decode()
+                if (instance_id == self.instance_id
+                        or await self.redis.exists(
+                            self._get_heartbeat_key(instance_id))):
+                    continue
+                adopted += await self._adopt(
+                    self._get_processing_key(instance_id)
+                )
+                await self.redis.srem(self.instances_key, instance_id)
+        except aioredis.RedisError as err:
+            logger.error(f'Ошибка Redis в очереди задач: {err}')
+        if adopted:
+            logger.info(f'Восстановлено задач из Redis: {adopted}')
+
+    async def _beat(self) -> None:
+        while True:
+            await asyncio.sleep(self.heartbeat_ttl / 3)
+            try:
+                await self._register_instance()
+                await self._adopt_orphans()
+            except Exception as err:
+                logger.error(f'Ошибка в очереди задач: {err!r}')
+
+    async def _finish(self, task: Dict[str, Any]) -> None:
+        await self._redis_call('lrem', self.processing_key, 1, task['raw'])
+
+    async def _bury(self, task: Dict[str, Any], error: Exception) -> None:
+        self.failed += 1
+        dead_letter = {
+            'id': task['id'],
+            'name': task['name'],
+            'args': task['args'],
+            'kwargs': task['kwargs'],
+            'attempts': task['attempts'],
+            'error': repr(error),
+        }
+        self.dead_letters.append(dead_letter)
+        logger.error(f'Задача {task["name"]} не выполнена после '
+                     f'{task["attempts"]} попыток: {error!r}')
+        await self._redis_call('rpush', self.dead_letters_key,
+                               json.dumps(dead_letter))
+        await self._redis_call('ltrim', self.dead_letters_key,
+                               -self.dead_letters_limit, -1)
+        await self._finish(task)
+
+    async def _requeue_later(self, task: Dict[str, Any],
+                             delay: float) -> None:
+        await asyncio.sleep(delay)
+        self._queue.put_nowait(task)
+
+    async def _run(self, task: Dict[str, Any]) -> None:
+        task['attempts'] += 1
+        handler = self._handlers.get(task['name'])
+        try:
+            if handler is None:
+                raise KeyError(f'Unknown task {task["name"]}')
+            await handler(*task['args'], **task['kwargs'])
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            if handler is None or task['attempts'] >= self.max_attempts:
+                await self._bury(task, err)
+                return
+            delay = self.retry_delay * 2 ** (task['attempts'] - 1)
+            logger.warning(f'Повтор задачи {task["name"]} через '
+                           f'{delay:.2f} с: {err!r}')
+            retry = asyncio.create_task(self._requeue_later(task, delay))
+            self._retries.add(retry)
+            retry.add_done_callback(self._retries.discard)
+        else:
+            self.completed += 1
+            await self._finish(task)
+
+    async def _work(self) -> None:
+        while True:
+            task = await self._queue.get()
+            try:
+                await self._run(task)
+            finally:
+                self._queue.task_done()
+
+    async def start(self) -> None:
+        if self._workers:
+            return
+        if self.redis:
+            await self._register_instance()
+            await self._adopt_orphans()
+            self._heartbeat = asyncio.create_task(self._beat())
+        self._accepting = True
+        self._workers = [asyncio.create_task(self._work())
+                         for _ in range(self.workers)]
+
+    async def drain(self, timeout: float = 10) -> None:
+        """Stops accepting tasks and waits for the queued ones.
+
+        Tasks still unfinished after ``timeout`` seconds, including the
+        ones waiting for a retry, stay in Redis and the heartbeat is
+        removed, so another instance or the next run takes them over.
+        """
+        self._accepting = False
+        try:
+            await asyncio.wait_for(self._wait_idle(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f'Очередь задач не опустела за {timeout} с, '
+                           f'осталось задач: {self._queue.qsize()}')
+        tasks = [*self._workers, *self._retries]
+        if self._heartbeat:
+            tasks.append(self._heartbeat)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._workers = []
+        self._retries.clear()
+        self._heartbeat = None
+        if self.redis:
+            if await self._redis_call('llen', self.processing_key) == 0:
+                await self._redis_call('srem', self.instances_key,
+                                       self.instance_id)
+            await self._redis_call('delete', self.heartbeat_key)
+
+    async def _wait_idle(self) -> None:
+        while True:
+            await self._queue.join()
+            if not self._retries:
+                return
+            await asyncio.wait(set(self._retries))
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'queued': self._queue.qsize(),
+            'waiting_retry': len(self._retries),
+            'completed': self.completed,
+            'failed': self.failed,
+            'dropped': self.dropped,
+            'dead_letters': len(self.dead_letters),
+        }
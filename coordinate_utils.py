@@ -1,21 +1,32 @@
-from typing import Tuple, List, Union, Dict
+import logging
+import re
+from typing import Tuple, List, Union, Dict, Optional
 
 import aiohttp
+import aioredis
+import numpy as np
 from geopy import distance
 
+from metrics import REGISTRY, MetricsRegistry, track
+from moltin_cache import AsyncTTLCache
+
+YANDEX_GEOCODER_URL = 'https://geocode-maps.yandex.ru/1.x'
+
+logger = logging.getLogger(__file__)
+
 
 async def fetch_coordinates(
-        address: str,
-        yandex_api_key: str) -> Union[None, Tuple[str, str]]:
-    url = 'https://geocode-maps.yandex.ru/1.x'
+        address: str, yandex_api_key: str,
+        url: str = YANDEX_GEOCODER_URL) -> Union[None, Tuple[str, str]]:
     params = {
         'geocode': address,
         'apikey': yandex_api_key,
         'format': 'json',
     }
-    async with aiohttp.ClientSession(raise_for_status=True) as session:
-        async with session.get(url, params=params) as response:
-            places = await response.json()
+    with track('geocoder_request'):
+        async with aiohttp.ClientSession(raise_for_status=True) as session:
+            async with session.get(url, params=params) as response:
+                places = await response.json()
 
     found_places = places['response'][
         'GeoObjectCollection'
@@ -29,27 +40,191 @@ async def fetch_coordinates(
     return lon, lat
 
 
-def get_nearest_restaurant(
-        order_coordinates: Tuple[str, str],
-        restaurants: List[Dict[str, str]]) -> Dict[str, str]:
-    distances = []
-    order_lon, order_lat = order_coordinates
-    for restaurant in restaurants:
-        order_distance = distance.distance(
-            (order_lat, order_lon),
-            (restaurant['Latitude'], restaurant['Longitude'])
+def normalize_address(address: str) -> str:
+    address = address.lower().replace('ё', 'е')
+    address = re.sub(r'[^\w\s]', ' ', address)
+    return ' '.join(address.split())
+
+
+class GeocodeCache:
+    """Two-level cache of geocoder results.
+
+    Addresses are normalized and looked up first in an in-process LRU and
+    then in Redis. Concurrent misses of the same address share one Redis
+    lookup and geocoder call. Addresses the geocoder could not resolve are
+    cached too, but only for ``negative_ttl`` seconds.
+    """
+
+    def __init__(self, redis: Optional[aioredis.Redis] = None,
+                 key_prefix: str = 'geocode', maxsize: int = 10000,
+                 ttl: int = 30 * 24 * 3600, negative_ttl: int = 600,
+                 geocoder_url: str = YANDEX_GEOCODER_URL,
+                 registry: MetricsRegistry = REGISTRY):
+        self.redis = redis
+        self.geocoder_url = geocoder_url
+        self.key_prefix = key_prefix
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.memory = AsyncTTLCache(maxsize, ttl)
+        self.memory_hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+        self.lookups = registry.counter(
+            'geocode_cache_lookups_total',
+            'Geocoding requests by the source of the result.', ('source',)
         )
-        distances.append(
-            {
-                'address': restaurant['Address'],
-                'lon': restaurant['Longitude'],
-                'lat': restaurant['Latitude'],
-                'id': restaurant['id'],
-                'distance_km': order_distance.kilometers,
-                'distance_m': order_distance.meters,
-                'courier_id': restaurant['Tg-id']
-            }
+
+    def _get_redis_key(self, address_key: str) -> str:
+        return f'{self.key_prefix}:{address_key}'
+
+    async def _redis_get(self, address_key: str) -> Optional[bytes]:
+        if not self.redis:
+            return None
+        try:
+            return await self.redis.get(self._get_redis_key(address_key))
+        except aioredis.RedisError as err:
+            logger.error(f'Не удалось прочитать кеш геокодера: {err}')
+            return None
+
+    async def _redis_set(self, address_key: str, value: str,
+                         ttl: int) -> None:
+        if not self.redis:
+            return
+        try:
+            await self.redis.set(self._get_redis_key(address_key), value,
+                                 ex=ttl)
+        except aioredis.RedisError as err:
+            logger.error(f'Не удалось записать кеш геокодера: {err}')
+
+    async def fetch_coordinates(
+            self, address: str,
+            yandex_api_key: str) -> Union[None, Tuple[str, str]]:
+        address_key = normalize_address(address)
+        source = 'memory'
+
+        async def load() -> Union[None, Tuple[str, str]]:
+            nonlocal source
+            cached_value = await self._redis_get(address_key)
+            if cached_value is not None:
+                source = 'redis'
+                if isinstance(cached_value, bytes):
+                    cached_value = cached_value.decode()
+                return tuple(cached_value.split()) or None
+
+            source = 'geocoder'
+            coordinates = await fetch_coordinates(address, yandex_api_key,
+                                                  self.geocoder_url)
+            ttl = self.ttl if coordinates else self.negative_ttl
+            await self._redis_set(address_key, ' '.join(coordinates or ()),
+                                  ttl)
+            return coordinates
+
+        coordinates = await self.memory.get_or_load(
+            address_key, load, negative_ttl=self.negative_ttl
         )
-    nearest_restaurant = min(distances,
-                             key=lambda rest: rest['distance_km'])
-    return nearest_restaurant
+        if source == 'memory':
+            self.memory_hits += 1
+        elif source == 'redis':
+            self.redis_hits += 1
+        else:
+            self.misses += 1
+        self.lookups.inc(source=source)
+        return coordinates
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        requests = self.memory_hits + self.redis_hits + self.misses
+        return {
+            'memory_hits': self.memory_hits,
+            'redis_hits': self.redis_hits,
+            'misses': self.misses,
+            'hit_rate': ((self.memory_hits + self.redis_hits) / requests
+                         if requests else 0.0),
+        }
+
+
+# Spherical and ellipsoidal distances differ by less than 0.5%, so every
+# restaurant that may be closer on the ellipsoid is inside this margin.
+SPHERE_ERROR_MARGIN = 1.01
+
+
+def _get_unit_vectors(latitudes: np.ndarray,
+                      longitudes: np.ndarray) -> np.ndarray:
+    latitudes = np.radians(latitudes)
+    longitudes = np.radians(longitudes)
+    return np.column_stack((
+        np.cos(latitudes) * np.cos(longitudes),
+        np.cos(latitudes) * np.sin(longitudes),
+        np.sin(latitudes),
+    ))
+
+
+def _describe_restaurant(restaurant: Dict[str, str],
+                         order_distance: distance.Distance) -> Dict[str, str]:
+    return {
+        'address': restaurant['Address'],
+        'lon': restaurant['Longitude'],
+        'lat': restaurant['Latitude'],
+        'id': restaurant['id'],
+        'distance_km': order_distance.kilometers,
+        'distance_m': order_distance.meters,
+        'courier_id': restaurant['Tg-id']
+    }
+
+
+class RestaurantsIndex:
+    """Nearest-neighbour index over restaurant coordinates.
+
+    Restaurants are stored as unit vectors in a NumPy array, so candidates
+    are selected by a vectorized great-circle search. The exact geodesic
+    distance is computed only for the candidates that can be the nearest.
+    """
+
+    def __init__(self, restaurants: List[Dict[str, str]]):
+        self.restaurants = list(restaurants)
+        latitudes = np.array([float(restaurant['Latitude'])
+                              for restaurant in self.restaurants])
+        longitudes = np.array([float(restaurant['Longitude'])
+                               for restaurant in self.restaurants])
+        self._vectors = _get_unit_vectors(latitudes, longitudes)
+
+    def __len__(self) -> int:
+        return len(self.restaurants)
+
+    def query(self, order_coordinates: Tuple[str, str],
+              k: int = 1) -> List[Dict[str, str]]:
+        if not self.restaurants:
+            return []
+        k = min(k, len(self.restaurants))
+        order_lon, order_lat = map(float, order_coordinates)
+        order_vector = _get_unit_vectors(np.array([order_lat]),
+                                         np.array([order_lon]))[0]
+        angles = np.arccos(np.clip(self._vectors @ order_vector, -1, 1))
+
+        kth_angle = np.partition(angles, k - 1)[k - 1]
+        candidates = np.flatnonzero(
+            angles <= kth_angle * SPHERE_ERROR_MARGIN + 1e-12
+        )
+        nearest_restaurants = []
+        for candidate in candidates:
+            restaurant = self.restaurants[candidate]
+            order_distance = distance.distance(
+                (order_lat, order_lon),
+                (restaurant['Latitude'], restaurant['Longitude'])
+            )
+            nearest_restaurants.append(
+                _describe_restaurant(restaurant, order_distance)
+            )
+        nearest_restaurants.sort(key=lambda rest: rest['distance_km'])
+        return nearest_restaurants[:k]
+
+    def nearest(self, order_coordinates: Tuple[str, str]) -> Dict[str, str]:
+        return self.query(order_coordinates, k=1)[0]
+
+
+def get_nearest_restaurant(
+        order_coordinates: Tuple[str, str],
+        restaurants: Union[List[Dict[str, str]],
+                           RestaurantsIndex]) -> Dict[str, str]:
+    if not isinstance(restaurants, RestaurantsIndex):
+        restaurants = RestaurantsIndex(restaurants)
+    return restaurants.nearest(order_coordinates)
@@ -0,0 +1,311 @@
+import asyncio
+import itertools
+import logging
+import os
+import random
+import time
+from collections import Counter, defaultdict
+from typing import Any, Dict, List, Optional, Tuple
+
+from aiohttp import web
+from environs import Env
+from telegram import Update
+from telegram.ext import ExtBot
+
+import stand_in_server
+from tg_bot import PizzaApplication, build_application
+from update_menu import create_menu, create_product_cards, create_promo_menu
+
+logger = logging.getLogger(__file__)
+
+LOAD_TEST_CHAT_ID_OFFSET = 10 ** 9
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'LoadTest',
+            'username': 'load_test_bot'}
+
+
+class RecordingBot(ExtBot):
+    """Bot that records Telegram API calls instead of sending them.
+
+    Every call is answered with a minimal valid result after ``latency``
+    seconds, so handlers work as with the real Bot API.
+    """
+
+    def __init__(self, token: str = '123456:load-test', latency: float = 0,
+                 **kwargs):
+        super().__init__(token, **kwargs)
+        self.latency = latency
+        self.calls: Counter = Counter()
+        self._message_ids = itertools.count(1)
+
+    def _get_fake_message(self, endpoint: str,
+                          data: Dict[str, Any]) -> Dict[str, Any]:
+        message_id = next(self._message_ids)
+        message = {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': data.get('chat_id'), 'type': 'private'},
+            'from': BOT_USER,
+        }
+        if endpoint == 'sendPhoto':
+            message['photo'] = [{
+                'file_id': f'photo-{message_id}',
+                'file_unique_id': f'unique-{message_id}',
+                'width': 600,
+                'height': 400,
+            }]
+        elif endpoint == 'sendLocation':
+            message['location'] = {
+                'latitude': data.get('latitude'),
+                'longitude': data.get('longitude'),
+            }
+        else:
+            message['text'] = str(data.get('text', ''))
+        return message
+
+    async def _post(self, endpoint: str, data: Dict[str, Any] = None,
+                    *args: Any, **kwargs: Any) -> Any:
+        self.calls[endpoint] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if endpoint == 'getMe':
+            return BOT_USER
+        if endpoint.startswith('send'):
+            return self._get_fake_message(endpoint, data or {})
+        return True
+
+
+class SimulatedChat:
+    """Builds updates a single private chat would send to the bot."""
+
+    update_ids = itertools.count(1)
+
+    def __init__(self, bot: ExtBot, chat_id: int):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.user = {'id': chat_id, 'is_bot': False,
+                     'first_name': f'User {chat_id}'}
+        self._message_ids = itertools.count(1)
+
+    def _get_message(self, **content: Any) -> Dict[str, Any]:
+        return {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': self.chat_id, 'type': 'private'},
+            'from': self.user,
+            **content,
+        }
+
+    def _get_update(self, **content: Any) -> Update:
+        return Update.de_json({'update_id': next(self.update_ids),
+                               **content}, self.bot)
+
+    def text(self, text: str) -> Update:
+        return self._get_update(message=self._get_message(text=text))
+
+    def location(self, longitude: float, latitude: float) -> Update:
+        location = {'longitude': longitude, 'latitude': latitude}
+        return self._get_update(message=self._get_message(location=location))
+
+    def callback(self, data: str) -> Update:
+        callback_query = {
+            'id': str(next(self.update_ids)),
+            'from': self.user,
+            'chat_instance': str(self.chat_id),
+            'data': data,
+            'message': {**self._get_message(text='...'), 'from': BOT_USER},
+        }
+        return self._get_update(callback_query=callback_query)
+
+
+def get_scenario(chat: SimulatedChat, product_id: str,
+                 rnd: random.Random) -> List[Tuple[Update, Optional[str]]]:
+    """Returns the updates of one order and the state expected after each."""
+    if rnd.random() < 0.5:
+        address = chat.text(f'Москва, ул. Нагрузочная, {rnd.randint(1, 500)}')
+    else:
+        address = chat.location(rnd.uniform(37.4, 37.8),
+                                rnd.uniform(55.6, 55.9))
+    return [
+        (chat.text('/start'), 'HANDLE_MENU'),
+        (chat.callback('page_2'), 'HANDLE_MENU'),
+        (chat.callback(f'product_{product_id}'), 'HANDLE_DESCRIPTION'),
+        (chat.callback(f'add_{product_id}'), 'HANDLE_DESCRIPTION'),
+        (chat.callback('menu'), 'HANDLE_MENU'),
+        (chat.callback('cart'), 'HANDLE_CART'),
+        (chat.callback('pay'), 'WAITING_EMAIL'),
+        (chat.text(f'user{chat.chat_id}@example.com'),
+         'HANDLE_PAYMENT_OPTION'),
+        (chat.callback('in_cash'), 'HANDLE_LOCATION'),
+        (address, 'HANDLE_DELIVERY'),
+        (chat.callback('pickup'), None),
+    ]
+
+
+class LoadTestReport:
+
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Counter = Counter()
+        self.started_at = time.perf_counter()
+        self.finished_at: Optional[float] = None
+
+    def record(self, state: str, latency: float, failed: bool) -> None:
+        self.latencies[state].append(latency)
+        if failed:
+            self.errors[state] += 1
+
+    @staticmethod
+    def get_percentile(latencies: List[float], percent: float) -> float:
+        rank = max(int(round(percent / 100 * len(latencies))) - 1, 0)
+        return latencies[rank]
+
+    def print(self, bot_calls: Counter, upstream_calls: Counter,
+              persistence_flush_time: float,
+              serializer_stats: Dict[str, Any]) -> None:
+        duration = self.finished_at - self.started_at
+        updates_count = sum(map(len, self.latencies.values()))
+        print(f'{"Состояние":<24}{"запросов":>10}{"ошибок":>8}'
+              f'{"p50, мс":>10}{"p95, мс":>10}{"p99, мс":>10}')
+        for state, latencies in self.latencies.items():
+            latencies = sorted(latencies)
+            p50, p95, p99 = (self.get_percentile(latencies, percent) * 1000
+                             for percent in (50, 95, 99))
+            print(f'{state:<24}{len(latencies):>10}{self.errors[state]:>8}'
+                  f'{p50:>10.1f}{p95:>10.1f}{p99:>10.1f}')
+        print(f'\nОбработано обновлений: {updates_count} за {duration:.1f} с '
+              f'({updates_count / duration:.1f} в секунду)')
+        print(f'Сохранение persistence: '
+              f'{persistence_flush_time * 1000:.1f} мс')
+        print(f'Сериализация ({serializer_stats["codec"]}): '
+              f'{serializer_stats["encoded"]:.0f} записей, '
+              f'в среднем {serializer_stats["average_encoded_bytes"]:.0f} '
+              f'байт, кодирование '
+              f'{serializer_stats["encode_seconds"] * 1000:.1f} мс, '
+              f'декодирование '
+              f'{serializer_stats["decode_seconds"] * 1000:.1f} мс')
+        for title, calls in (('Запросы к Telegram', bot_calls),
+                             ('Запросы к Moltin и геокодеру', upstream_calls)):
+            if not calls:
+                continue
+            print(f'\n{title}: {sum(calls.values())}')
+            for endpoint, count in calls.most_common():
+                print(f'  {endpoint:<50}{count:>8}')
+
+
+async def prepare_bot_data(application: PizzaApplication) -> List[str]:
+    moltin = application.moltin
+    moltin_token = await application.moltin_tokens.get_token()
+    products, categories, promo_menu = await asyncio.gather(
+        moltin.get_products(moltin_token, include='main_image'),
+        moltin.get_categories(moltin_token),
+        create_promo_menu(moltin, moltin_token)
+    )
+    product_cards = await create_product_cards(moltin, moltin_token,
+                                               products, categories['data'])
+    application.bot_data.update({
+        'menu': create_menu(products['data'], 8),
+        'product_cards': product_cards,
+        'promo_menu': promo_menu,
+    })
+    return list(product_cards)
+
+
+async def run_chat(application: PizzaApplication, chat: SimulatedChat,
+                   scenario: List[Tuple[Update, Optional[str]]],
+                   report: LoadTestReport, think_time: float) -> None:
+    for update, expected_state in scenario:
+        user_data = application.user_data[chat.chat_id]
+        state = 'START' if update.message and (
+            update.message.text == '/start'
+        ) else user_data.get('state')
+
+        started_at = time.perf_counter()
+        await application.process_update(update)
+        latency = time.perf_counter() - started_at
+
+        failed = user_data.get('state') != expected_state
+        report.record(state, latency, failed)
+        if failed:
+            return
+        if think_time:
+            await asyncio.sleep(think_time)
+
+
+async def start_stand_in(env: Env) -> Tuple[web.AppRunner, web.Application]:
+    app = stand_in_server.create_app(
+        latency=(env.float('STAND_IN_LATENCY_MIN', 0),
+                 env.float('STAND_IN_LATENCY_MAX', 0)),
+        error_rate=env.float('STAND_IN_ERROR_RATE', 0),
+        rate_limit_rate=env.float('STAND_IN_RATE_LIMIT_RATE', 0),
+        retry_after=env.int('STAND_IN_RETRY_AFTER', 1),
+    )
+    runner = web.AppRunner(app)
+    await runner.setup()
+    port = env.int('STAND_IN_PORT', 8080)
+    await web.TCPSite(runner, '127.0.0.1', port).start()
+
+    stand_in_url = f'http://127.0.0.1:{port}'
+    os.environ['MOLTIN_API_URL'] = stand_in_url
+    os.environ['YANDEX_GEOCODER_URL'] = f'{stand_in_url}/1.x'
+    for env_name in ('CLIENT_ID', 'CLIENT_SECRET', 'YANDEX_API_KEY',
+                     'PAYMENT_PROVIDER_TOKEN'):
+        os.environ.setdefault(env_name, 'load-test')
+    return runner, app
+
+
+async def main() -> None:
+    env = Env()
+    env.read_env()
+    logging.basicConfig(level=env.log_level('LOAD_TEST_LOG_LEVEL',
+                                            logging.WARNING))
+
+    chats_count = env.int('LOAD_TEST_CHATS', 1000)
+    concurrency = env.int('LOAD_TEST_CONCURRENCY', 100)
+    think_time = env.float('LOAD_TEST_THINK_TIME', 0)
+    rnd = random.Random(env.int('LOAD_TEST_SEED', 0))
+    os.environ.setdefault('DB_MAIN_KEY', 'load_test')
+
+    stand_in_runner = stand_in_app = None
+    if env.bool('LOAD_TEST_STAND_IN', True):
+        stand_in_runner, stand_in_app = await start_stand_in(env)
+
+    bot = RecordingBot(latency=env.float('LOAD_TEST_BOT_LATENCY', 0))
+    application = build_application(env, bot=bot)
+    await application.initialize()
+    try:
+        products_ids = await prepare_bot_data(application)
+        bot.calls.clear()
+        if stand_in_app:
+            stand_in_app['request_counts'].clear()
+
+        semaphore = asyncio.Semaphore(concurrency)
+        report = LoadTestReport()
+
+        async def run_limited_chat(chat_number: int) -> None:
+            chat = SimulatedChat(bot, LOAD_TEST_CHAT_ID_OFFSET + chat_number)
+            scenario = get_scenario(chat, rnd.choice(products_ids), rnd)
+            async with semaphore:
+                await run_chat(application, chat, scenario, report,
+                               think_time)
+
+        await asyncio.gather(*map(run_limited_chat, range(chats_count)))
+        report.finished_at = time.perf_counter()
+        await application.tasks.drain()
+
+        flush_started_at = time.perf_counter()
+        await application.update_persistence()
+        await application.persistence.flush()
+        persistence_flush_time = time.perf_counter() - flush_started_at
+
+        upstream_calls = (stand_in_app['request_counts'] if stand_in_app
+                          else Counter())
+        report.print(bot.calls, upstream_calls, persistence_flush_time,
+                     application.persistence.serializer.stats())
+    finally:
+        await application.shutdown()
+        if stand_in_runner:
+            await stand_in_runner.cleanup()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,225 @@
+import logging
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Tuple
+
+from aiohttp import web
+from telegram.request import HTTPXRequest
+
+logger = logging.getLogger(__file__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape_label_value(value: str) -> str:
+    return (value.replace('\\', r'\\').replace('"', r'\"')
+            .replace('\n', r'\n'))
+
+
+def _format_labels(label_names: Tuple[str, ...], label_values: LabelValues,
+                   **extra_labels: str) -> str:
+    labels = [*zip(label_names, label_values), *extra_labels.items()]
+    if not labels:
+        return ''
+    formatted_labels = ','.join(f'{name}="{_escape_label_value(value)}"'
+                                for name, value in labels)
+    return f'{{{formatted_labels}}}'
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    type = ''
+
+    def __init__(self, name: str, documentation: str,
+                 label_names: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+
+    def _get_label_values(self, labels: Dict[str, str]) -> LabelValues:
+        if set(labels) != set(self.label_names):
+            raise ValueError(f'{self.name} expects labels {self.label_names}')
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def _render_samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        return [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} {self.type}',
+            *self._render_samples(),
+        ]
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        label_values = self._get_label_values(labels)
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def _render_samples(self) -> List[str]:
+        return [
+            f'{self.name}{_format_labels(self.label_names, label_values)} '
+            f'{_format_value(value)}'
+            for label_values, value in self.values.items()
+        ]
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def dec(self, amount: float = 1, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels: str) -> None:
+        self.values[self._get_label_values(labels)] = value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, *args, buckets: Tuple[float, ...] = DEFAULT_BUCKETS,
+                 **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = (*sorted(buckets), float('inf'))
+        self.bucket_counts: Dict[LabelValues, List[int]] = {}
+        self.sums: Dict[LabelValues, float] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        label_values = self._get_label_values(labels)
+        if label_values not in self.bucket_counts:
+            self.bucket_counts[label_values] = [0] * len(self.buckets)
+            self.sums[label_values] = 0.0
+        self.bucket_counts[label_values][bisect_left(self.buckets,
+                                                     value)] += 1
+        self.sums[label_values] += value
+
+    def _render_samples(self) -> List[str]:
+        samples = []
+        for label_values, bucket_counts in self.bucket_counts.items():
+            cumulative_count = 0
+            for bucket, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative_count += bucket_count
+                labels = _format_labels(self.label_names, label_values,
+                                        le=_format_value(bucket))
+                samples.append(f'{self.name}_bucket{labels} '
+                               f'{cumulative_count}')
+            labels = _format_labels(self.label_names, label_values)
+            samples.append(f'{self.name}_sum{labels} '
+                           f'{_format_value(self.sums[label_values])}')
+            samples.append(f'{self.name}_count{labels} {cumulative_count}')
+        return samples
+
+
+class MetricsRegistry:
+
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+
+    def _get_or_create(self, metric_class: type, name: str,
+                       documentation: str, label_names: Tuple[str, ...],
+                       **kwargs) -> Metric:
+        if metric := self.metrics.get(name):
+            if (not isinstance(metric, metric_class)
+                    or metric.label_names != label_names):
+                raise ValueError(f'Metric {name} is already registered')
+            return metric
+        metric = metric_class(name, documentation, label_names, **kwargs)
+        self.metrics[name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str,
+                label_names: Tuple[str, ...] = ()) -> Counter:
+        return self._get_or_create(Counter, name, documentation, label_names)
+
+    def gauge(self, name: str, documentation: str,
+              label_names: Tuple[str, ...] = ()) -> Gauge:
+        return self._get_or_create(Gauge, name, documentation, label_names)
+
+    def histogram(self, name: str, documentation: str,
+                  label_names: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self._get_or_create(Histogram, name, documentation,
+                                   label_names, buckets=buckets)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines += metric.render()
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+
+@contextmanager
+def track(operation: str, registry: MetricsRegistry = REGISTRY,
+          **labels: str) -> Iterator[None]:
+    """Measures a block as one ``operation``.
+
+    Records ``<operation>_duration_seconds``, ``<operation>_errors_total``
+    and ``<operation>_in_flight`` with the given labels.
+    """
+    label_names = tuple(labels)
+    duration = registry.histogram(f'{operation}_duration_seconds',
+                                  f'Duration of {operation} in seconds.',
+                                  label_names)
+    errors = registry.counter(f'{operation}_errors_total',
+                              f'Number of failed {operation} calls.',
+                              label_names)
+    in_flight = registry.gauge(f'{operation}_in_flight',
+                               f'Number of {operation} calls in progress.',
+                               label_names)
+    in_flight.inc(**labels)
+    started_at = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        errors.inc(**labels)
+        raise
+    finally:
+        duration.observe(time.perf_counter() - started_at, **labels)
+        in_flight.dec(**labels)
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """Bot API request that records metrics of every Telegram method."""
+
+    async def post(self, url: str, *args, **kwargs) -> Any:
+        with track('telegram_request', method=url.rsplit('/', 1)[-1]):
+            return await super().post(url, *args, **kwargs)
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    registry = request.app['registry']
+    return web.Response(body=registry.render().encode(),
+                        headers={'Content-Type': PROMETHEUS_CONTENT_TYPE})
+
+
+async def start_metrics_server(
+        host: str, port: int,
+        registry: MetricsRegistry = REGISTRY) -> web.AppRunner:
+    app = web.Application()
+    app['registry'] = registry
+    app.router.add_get('/metrics', handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f'Метрики доступны на http://{host}:{port}/metrics')
+    return runner
+
@@ -1,396 +1,575 @@
-from typing import Dict, Union, List, Any
+import asyncio
+import logging
+import re
+import time
+from typing import Dict, Union, List, Any, Optional
 
 import aiohttp
 from slugify import slugify
+from yarl import URL
+
+from metrics import track
+from resilience import CircuitBreaker, RetryPolicy
+
+MOLTIN_API_URL = 'https://api.moltin.com'
+ID_SEGMENT_PATTERN = re.compile(r'^(\d+|[0-9a-f]{8}-[0-9a-f-]{27})$')
+
+logger = logging.getLogger(__file__)
+
+
+class MoltinClient:
+    """Moltin API client reusing one pooled keep-alive session.
+
+    The session is created lazily inside the running event loop and lives
+    until :meth:`close` is called, so TCP and TLS connections to Moltin are
+    shared between all requests of the process.
+
+    GET requests are retried according to ``retry_policy`` within its
+    deadline, and every request goes through ``circuit_breaker``, which
+    rejects calls while Moltin keeps failing.
+    """
+
+    def __init__(self, base_url: str = MOLTIN_API_URL,
+                 connections_limit: int = 100,
+                 connections_limit_per_host: int = 30,
+                 keepalive_timeout: float = 30,
+                 dns_cache_ttl: int = 300,
+                 request_timeout: float = 30,
+                 retry_policy: RetryPolicy = None,
+                 circuit_breaker: CircuitBreaker = None):
+        self.base_url = base_url.rstrip('/')
+        self.connections_limit = connections_limit
+        self.connections_limit_per_host = connections_limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self.request_timeout = request_timeout
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.circuit_breaker = circuit_breaker or CircuitBreaker('moltin')
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    async def __aenter__(self) -> 'MoltinClient':
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.connections_limit,
+                limit_per_host=self.connections_limit_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+                use_dns_cache=True,
+                ttl_dns_cache=self.dns_cache_ttl,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.request_timeout)
+            )
+        return self._session
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    def _url(self, path: str) -> str:
+        return f'{self.base_url}{path}'
+
+    @staticmethod
+    def _auth_headers(access_token: str, **headers: str) -> Dict[str, str]:
+        return {
+            'Authorization': f'Bearer {access_token}',
+            **headers
+        }
 
-
-async def get_access_token(client_id: str,
-                           client_secret: str) -> Dict[str, str]:
-    url = 'https://api.moltin.com/oauth/access_token'
-    payload = {
-        'client_id': client_id,
-        'client_secret': client_secret,
-        'grant_type': 'client_credentials'
-    }
-    async with aiohttp.ClientSession(raise_for_status=True) as session:
-        async with session.post(url, data=payload) as response:
-            return await response.json()
-
-
-async def get_products(access_token: str) -> Dict[str, str]:
-    url = 'https://api.moltin.com/v2/products'
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-    }
-    async with aiohttp.ClientSession(raise_for_status=True,
-                                     headers=headers) as session:
-        async with session.get(url) as response:
-            return await response.json()
-
-
-async def get_product(access_token: str,
-                      product_id: Union[str, int]) -> Dict[str, Any]:
-    url = f'https://api.moltin.com/v2/products/{product_id}'
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-    }
-    async with aiohttp.ClientSession(raise_for_status=True,
-                                     headers=headers) as session:
-        async with session.get(url) as response:
-            return await response.json()
-
-
-async def get_product_by_sku(access_token: str,
-                             product_sku: str) -> Dict[str, Any]:
-    url = 'https://api.moltin.com/v2/products'
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-    }
-    payload = {
-        'filter': f'eq(sku, {product_sku})'
-    }
-    async with aiohttp.ClientSession(raise_for_status=True,
-                                     headers=headers) as session:
-        async with session.get(url, params=payload) as response:
-            return await response.json()
-
-
-async def get_product_main_image_url(access_token: str,
-                                     image_id: Union[str, int]) -> str:
-    url = f'https://api.moltin.com/v2/files/{image_id}'
-    headers = {
-        'Authorization': f'Bearer {access_token}'
-    }
-    async with aiohttp.ClientSession(raise_for_status=True,
-                                     headers=headers) as session:
-        async with session.get(url) as response:
-            main_image = await response.json()
-    return main_image['data']['link']['href']
-
-
-async def create_product(access_token: str, product_id: Union[str, int],
-                         name: str, description: str,
-                         price: Union[str, int, float],
-                         slug: str = None) -> Dict[str, str]:
-    url = 'https://api.moltin.com/v2/products'
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-    }
-    product_description = {
-        'data': {
-            'type': 'product',
-            'name': name,
-            'slug': slug if slug else slugify(name),
-            'sku': f'sku-{product_id}',
-            'description': description,
-            'manage_stock': False,
-            'price': [
-                {
-                    'amount': int(price) * 100,
-                    'currency': 'RUB',
-                    'includes_tax': True,
-                },
-            ],
-            'status': 'live',
-            'commodity_type': 'physical',
-        },
-    }
-    async with aiohttp.ClientSession(raise_for_status=True,
-                                     headers=headers) as session:
-        async with session.post(url, json=product_description) as response:
-            return await response.json()
-
-
-async def add_product_main_image(access_token: str,
-                                 product_id: Union[str, int],
-                                 image_id: Union[str, int]) -> Dict[str, str]:
-    url = f'https://api.moltin.com/v2/products/{product_id}/relationships/main-image'
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-    }
-    image_description = {
-        'data': {
-            'type': 'main_image',
-            'id': image_id,
-        },
-    }
-    async with aiohttp.ClientSession(raise_for_status=True,
-                                     headers=headers) as session:
-        async with session.post(url, json=image_description) as response:
-            return await response.json()
-
-
-async def delete_product(access_token: str, product_id: str) -> bool:
-    url = f'https://api.moltin.com/v2/products/{product_id}'
-    headers = {
-        'Authorization': f'Bearer {access_token}'
-    }
-    async with aiohttp.ClientSession(headers=headers) as session:
-        async with session.delete(url) as response:
-            return response.ok
-
-
-async def get_or_create_cart(access_token: str, cart_id: Union[str, int],
-                             currency: str = 'RUB') -> Dict[str, Any]:
-    url = f'https://api.moltin.com/v2/carts/{cart_id}'
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-        'X-MOLTIN-CURRENCY': currency
-    }
-    async with aiohttp.ClientSession(raise_for_status=True,
-                                     headers=headers) as session:
-        async with session.get(url) as response:
-            return await response.json()
-
-
-async def get_cart_items(access_token: str,
-                         cart_id: Union[str, int]) -> Dict[str, str]:
-    url = f'https://api.moltin.com/v2/carts/{cart_id}/items'
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-    }
-    async with aiohttp.ClientSession(raise_for_status=True,
-                                     headers=headers) as session:
-        async with session.get(url) as response:
-            return await response.json()
-
-
-async def add_cart_item(access_token: str, cart_id: Union[str, int],
-                        item_id: Union[str, int],
-                        item_quantity: Union[str, int],
-                        currency: str = 'RUB') -> Dict[str, str]:
-    url = f'https://api.moltin.com/v2/carts/{cart_id}/items'
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-        'X-MOLTIN-CURRENCY': currency
-    }
-
-    cart_item = {
-        'data': {
-            'id': item_id,
-            'type': 'cart_item',
-            'quantity': item_quantity,
-        },
-    }
-    async with aiohttp.ClientSession(raise_for_status=True,
-                                     headers=headers) as session:
-        async with session.post(url, json=cart_item) as response:
-            return await response.json()
-
-
-async def remove_cart_item(access_token: str, cart_id: Union[str, int],
-                           item_id: Union[str, int]) -> bool:
-    url = f'https://api.moltin.com/v2/carts/{cart_id}/items/{item_id}'
-    headers = {
-        'Authorization': f'Bearer {access_token}'
-    }
-    async with aiohttp.ClientSession(raise_for_status=True,
-                                     headers=headers) as session:
-        async with session.delete(url) as response:
-            return response.ok
-
-
-async def delete_cart(access_token: str, cart_id: Union[str, int]) -> bool:
-    url = f'https://api.moltin.com/v2/carts/{cart_id}'
-    headers = {
-        'Authorization': f'Bearer {access_token}'
-    }
-    async with aiohttp.ClientSession(raise_for_status=True,
-                                     headers=headers) as session:
-        async with session.delete(url) as response:
-            return response.ok
-
-
-async def get_customer_by_email(access_token: str,
-                                email: str) -> Dict[str, str]:
-    url = f'https://api.moltin.com/v2/customers'
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-    }
-    payload = {
-        'filter': f'eq(email, {email})'
-    }
-    async with aiohttp.ClientSession(raise_for_status=True,
-                                     headers=headers) as session:
-        async with session.get(url, params=payload) as response:
-            return await response.json()
-
-
-async def create_customer(access_token: str, email: str,
-                          name: str = None) -> Dict[str, str]:
-    url = 'https://api.moltin.com/v2/customers'
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-    }
-
-    customer = {
-        'data': {
-            'type': 'customer',
-            'name': name if name else email.split('@')[0],
-            'email': email,
-        },
-    }
-    async with aiohttp.ClientSession(raise_for_status=True,
-                                     headers=headers) as session:
-        async with session.post(url, json=customer) as response:
-            return await response.json()
-
-
-async def get_or_create_customer_by_email(access_token: str, email: str,
-                                          name: str = None) -> Dict[str, str]:
-    customer = await get_customer_by_email(access_token, email)
-    if not customer['data']:
-        customer = await create_customer(access_token, email, name)
-    return customer
-
-
-async def create_file(access_token: str, file_url: str) -> Dict[str, str]:
-    url = 'https://api.moltin.com/v2/files'
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-    }
-    files = {
-        'file_location': (None, file_url),
-    }
-    async with aiohttp.ClientSession(raise_for_status=True,
-                                     headers=headers) as session:
-        async with session.post(url, json=files) as response:
-            return await response.json()
-
-
-async def create_flow(access_token: str, name: str, description: str,
-                      slug: str = None,
-                      enabled: bool = True) -> Dict[str, str]:
-    url = 'https://api.moltin.com/v2/flows'
-    headers = {
-        'Authorization': f'Bearer {access_token}'
-    }
-    flow_description = {
-        'data': {
-            'type': 'flow',
-            'name': name,
-            'slug': slug if slug else slugify(name),
-            'description': description,
-            'enabled': enabled,
-        },
-    }
-    async with aiohttp.ClientSession(raise_for_status=True,
-                                     headers=headers) as session:
-        async with session.post(url, json=flow_description) as response:
+    async def _send(self, method: str, url: str, raise_for_status: bool,
+                    return_json: bool, **kwargs) -> Any:
+        session = self._get_session()
+        async with session.request(method, url, **kwargs) as response:
+            if raise_for_status:
+                response.raise_for_status()
+            if not return_json:
+                return response.ok
             return await response.json()
 
-
-async def create_flow_field(
-        access_token: str, flow_id: Union[str, int], name: str,
-        field_type: str, description: str, slug: str = None,
-        required: bool = True, enabled: bool = True,
-        default: Union[str, int] = None) -> Dict[str, str]:
-    url = 'https://api.moltin.com/v2/fields'
-    headers = {
-        'Authorization': f'Bearer {access_token}'
-    }
-    field_description = {
-        'data': {
-            'type': 'field',
-            'name': name,
-            'slug': slug if slug else slugify(name),
-            'field_type': field_type,
-            'description': description,
-            'required': required,
-            'enabled': enabled,
-            'relationships': {
-                'flow': {
-                    'data': {
-                        'type': 'flow',
-                        'id': flow_id,
+    @staticmethod
+    def _get_endpoint(url: str) -> str:
+        path_segments = [
+            '{id}' if ID_SEGMENT_PATTERN.match(segment) else segment
+            for segment in URL(url).path.split('/')
+        ]
+        return '/'.join(path_segments)
+
+    async def _request(self, method: str, url: str, **kwargs) -> Any:
+        with track('moltin_request', method=method,
+                   endpoint=self._get_endpoint(url)):
+            return await self._request_with_retries(method, url, **kwargs)
+
+    async def _request_with_retries(self, method: str, url: str,
+                                    raise_for_status: bool = True,
+                                    return_json: bool = True,
+                                    retry: bool = None, **kwargs) -> Any:
+        policy = self.retry_policy
+        if retry is None:
+            retry = method == 'GET'
+        max_attempts = policy.max_attempts if retry else 1
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + policy.deadline
+
+        for attempt in range(1, max_attempts + 1):
+            self.circuit_breaker.before_call()
+            retry_after = None
+            try:
+                timeout = min(deadline - loop.time(), self.request_timeout)
+                if timeout <= 0:
+                    raise asyncio.TimeoutError()
+                result = await self._send(
+                    method, url, raise_for_status, return_json,
+                    timeout=aiohttp.ClientTimeout(total=timeout), **kwargs
+                )
+            except aiohttp.ClientResponseError as err:
+                if err.status >= 500:
+                    self.circuit_breaker.record_failure()
+                elif err.status != 429:
+                    self.circuit_breaker.record_success()
+                if err.status not in policy.retry_statuses:
+                    raise
+                retry_after = policy.parse_retry_after(err.headers)
+                error = err
+            except (aiohttp.ClientConnectionError,
+                    asyncio.TimeoutError) as err:
+                self.circuit_breaker.record_failure()
+                error = err
+            else:
+                self.circuit_breaker.record_success()
+                return result
+
+            delay = policy.get_delay(attempt, retry_after)
+            if attempt == max_attempts or loop.time() + delay >= deadline:
+                raise error
+            logger.warning(f'Повтор запроса {method} {url} через '
+                           f'{delay:.2f} с: {type(error).__name__} {error}')
+            await asyncio.sleep(delay)
+
+    async def get_access_token(self, client_id: str,
+                               client_secret: str) -> Dict[str, str]:
+        url = self._url('/oauth/access_token')
+        payload = {
+            'client_id': client_id,
+            'client_secret': client_secret,
+            'grant_type': 'client_credentials'
+        }
+        return await self._request('POST', url, data=payload, retry=True)
+
+    async def get_products(self, access_token: str,
+                           include: str = None) -> Dict[str, Any]:
+        url = self._url('/v2/products')
+        headers = self._auth_headers(access_token)
+        payload = {'include': include} if include else None
+        return await self._request('GET', url, headers=headers,
+                                   params=payload)
+
+    async def get_product(self, access_token: str,
+                          product_id: Union[str, int]) -> Dict[str, Any]:
+        url = self._url(f'/v2/products/{product_id}')
+        headers = self._auth_headers(access_token)
+        return await self._request('GET', url, headers=headers)
+
+    async def get_product_by_sku(self, access_token: str,
+                                 product_sku: str) -> Dict[str, Any]:
+        url = self._url('/v2/products')
+        headers = self._auth_headers(access_token)
+        payload = {
+            'filter': f'eq(sku, {product_sku})'
+        }
+        return await self._request('GET', url, headers=headers,
+                                   params=payload)
+
+    async def get_products_by_skus(
+            self, access_token: str, products_sku: List[str],
+            batch_size: int = 25,
+            concurrency: int = 4) -> List[Dict[str, Any]]:
+        url = self._url('/v2/products')
+        headers = self._auth_headers(access_token)
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def get_batch(batch: List[str]) -> List[Dict[str, Any]]:
+            payload = {
+                'filter': f'in(sku,{",".join(batch)})'
+            }
+            async with semaphore:
+                products = await self._request('GET', url, headers=headers,
+                                               params=payload)
+            return products['data']
+
+        batches = [products_sku[i:i + batch_size]
+                   for i in range(0, len(products_sku), batch_size)]
+        products_per_batch = await asyncio.gather(*map(get_batch, batches))
+        products_per_sku = {
+            product['sku']: product
+            for products in products_per_batch for product in products
+        }
+        return [products_per_sku[product_sku] for product_sku in products_sku
+                if product_sku in products_per_sku]
+
+    async def get_product_main_image_url(self, access_token: str,
+                                         image_id: Union[str, int]) -> str:
+        url = self._url(f'/v2/files/{image_id}')
+        headers = self._auth_headers(access_token)
+        main_image = await self._request('GET', url, headers=headers)
+        return main_image['data']['link']['href']
+
+    async def create_product(self, access_token: str,
+                             product_id: Union[str, int],
+                             name: str, description: str,
+                             price: Union[str, int, float],
+                             slug: str = None) -> Dict[str, str]:
+        url = self._url('/v2/products')
+        headers = self._auth_headers(access_token)
+        product_description = {
+            'data': {
+                'type': 'product',
+                'name': name,
+                'slug': slug if slug else slugify(name),
+                'sku': f'sku-{product_id}',
+                'description': description,
+                'manage_stock': False,
+                'price': [
+                    {
+                        'amount': int(price) * 100,
+                        'currency': 'RUB',
+                        'includes_tax': True,
+                    },
+                ],
+                'status': 'live',
+                'commodity_type': 'physical',
+            },
+        }
+        return await self._request('POST', url, headers=headers,
+                                   json=product_description)
+
+    async def add_product_main_image(
+            self, access_token: str, product_id: Union[str, int],
+            image_id: Union[str, int]) -> Dict[str, str]:
+        url = self._url(
+            f'/v2/products/{product_id}/relationships/main-image'
+        )
+        headers = self._auth_headers(access_token)
+        image_description = {
+            'data': {
+                'type': 'main_image',
+                'id': image_id,
+            },
+        }
+        return await self._request('POST', url, headers=headers,
+                                   json=image_description)
+
+    async def delete_product(self, access_token: str,
+                             product_id: str) -> bool:
+        url = self._url(f'/v2/products/{product_id}')
+        headers = self._auth_headers(access_token)
+        return await self._request('DELETE', url, headers=headers,
+                                   raise_for_status=False,
+                                   return_json=False)
+
+    async def get_or_create_cart(self, access_token: str,
+                                 cart_id: Union[str, int],
+                                 currency: str = 'RUB') -> Dict[str, Any]:
+        url = self._url(f'/v2/carts/{cart_id}')
+        headers = self._auth_headers(access_token,
+                                     **{'X-MOLTIN-CURRENCY': currency})
+        return await self._request('GET', url, headers=headers)
+
+    async def get_cart_items(self, access_token: str,
+                             cart_id: Union[str, int]) -> Dict[str, str]:
+        url = self._url(f'/v2/carts/{cart_id}/items')
+        headers = self._auth_headers(access_token)
+        return await self._request('GET', url, headers=headers)
+
+    async def add_cart_item(self, access_token: str,
+                            cart_id: Union[str, int],
+                            item_id: Union[str, int],
+                            item_quantity: Union[str, int],
+                            currency: str = 'RUB') -> Dict[str, str]:
+        url = self._url(f'/v2/carts/{cart_id}/items')
+        headers = self._auth_headers(access_token,
+                                     **{'X-MOLTIN-CURRENCY': currency})
+        cart_item = {
+            'data': {
+                'id': item_id,
+                'type': 'cart_item',
+                'quantity': item_quantity,
+            },
+        }
+        return await self._request('POST', url, headers=headers,
+                                   json=cart_item)
+
+    async def remove_cart_item(self, access_token: str,
+                               cart_id: Union[str, int],
+                               item_id: Union[str, int]) -> Dict[str, Any]:
+        url = self._url(f'/v2/carts/{cart_id}/items/{item_id}')
+        headers = self._auth_headers(access_token)
+        return await self._request('DELETE', url, headers=headers)
+
+    async def delete_cart(self, access_token: str,
+                          cart_id: Union[str, int]) -> bool:
+        url = self._url(f'/v2/carts/{cart_id}')
+        headers = self._auth_headers(access_token)
+        return await self._request('DELETE', url, headers=headers,
+                                   return_json=False)
+
+    async def get_customer_by_email(self, access_token: str,
+                                    email: str) -> Dict[str, str]:
+        url = self._url('/v2/customers')
+        headers = self._auth_headers(access_token)
+        payload = {
+            'filter': f'eq(email, {email})'
+        }
+        return await self._request('GET', url, headers=headers,
+                                   params=payload)
+
+    async def create_customer(self, access_token: str, email: str,
+                              name: str = None) -> Dict[str, str]:
+        url = self._url('/v2/customers')
+        headers = self._auth_headers(access_token)
+        customer = {
+            'data': {
+                'type': 'customer',
+                'name': name if name else email.split('@')[0],
+                'email': email,
+            },
+        }
+        return await self._request('POST', url, headers=headers,
+                                   json=customer)
+
+    async def get_or_create_customer_by_email(
+            self, access_token: str, email: str,
+            name: str = None) -> Dict[str, str]:
+        customer = await self.get_customer_by_email(access_token, email)
+        if not customer['data']:
+            customer = await self.create_customer(access_token, email, name)
+        return customer
+
+    async def create_file(self, access_token: str,
+                          file_url: str) -> Dict[str, str]:
+        url = self._url('/v2/files')
+        headers = self._auth_headers(access_token)
+        files = {
+            'file_location': (None, file_url),
+        }
+        return await self._request('POST', url, headers=headers, json=files)
+
+    async def create_flow(self, access_token: str, name: str,
+                          description: str, slug: str = None,
+                          enabled: bool = True) -> Dict[str, str]:
+        url = self._url('/v2/flows')
+        headers = self._auth_headers(access_token)
+        flow_description = {
+            'data': {
+                'type': 'flow',
+                'name': name,
+                'slug': slug if slug else slugify(name),
+                'description': description,
+                'enabled': enabled,
+            },
+        }
+        return await self._request('POST', url, headers=headers,
+                                   json=flow_description)
+
+    async def create_flow_field(
+            self, access_token: str, flow_id: Union[str, int], name: str,
+            field_type: str, description: str, slug: str = None,
+            required: bool = True, enabled: bool = True,
+            default: Union[str, int] = None) -> Dict[str, str]:
+        url = self._url('/v2/fields')
+        headers = self._auth_headers(access_token)
+        field_description = {
+            'data': {
+                'type': 'field',
+                'name': name,
+                'slug': slug if slug else slugify(name),
+                'field_type': field_type,
+                'description': description,
+                'required': required,
+                'enabled': enabled,
+                'relationships': {
+                    'flow': {
+                        'data': {
+                            'type': 'flow',
+                            'id': flow_id,
+                        },
                     },
                 },
             },
-        },
-    }
-    if default:
-        field_description['data'].update({'default': default})
-    async with aiohttp.ClientSession(raise_for_status=True,
-                                     headers=headers) as session:
-        async with session.post(url, json=field_description) as response:
-            return await response.json()
-
-
-async def create_flow_entry(
-        access_token: str, flow_slug: str,
-        fields_slug_per_value: Dict[str, str]) -> Dict[str, str]:
-    url = f'https://api.moltin.com/v2/flows/{flow_slug}/entries'
-    headers = {
-        'Authorization': f'Bearer {access_token}'
-    }
-    entry_description = {
-        'data': {
-            'type': 'entry',
-            **fields_slug_per_value
         }
-    }
-    async with aiohttp.ClientSession(raise_for_status=True,
-                                     headers=headers) as session:
-        async with session.post(url, json=entry_description) as response:
-            return await response.json()
-
-
-async def get_entries(access_token: str, flow_slug: str,
-                      next_page_url: str = None) -> Dict[str, Any]:
-    url = next_page_url or f'https://api.moltin.com/v2/flows/{flow_slug}/entries'
-    headers = {
-        'Authorization': f'Bearer {access_token}'
-    }
-    payload = {
-        'page[limit]': 100,
-    }
-    async with aiohttp.ClientSession(raise_for_status=True,
-                                     headers=headers) as session:
-        async with session.get(url, params=payload) as response:
-            return await response.json()
-
-
-async def get_available_entries(access_token: str,
-                                flow_slug: str) -> List[Dict[str, Any]]:
-    available_entries = []
-    entries = await get_entries(access_token, flow_slug=flow_slug)
-    available_entries += entries['data']
-    while next_page_url := entries['links']['next']:
-        entries = await get_entries(access_token, flow_slug=flow_slug,
-                                    next_page_url=next_page_url)
-        available_entries += entries['data']
-    return available_entries
-
-
-async def get_categories(access_token: str) -> Dict[str, Any]:
-    url = 'https://api.moltin.com/v2/categories'
-    headers = {
-        'Authorization': f'Bearer {access_token}'
-    }
-    async with aiohttp.ClientSession(raise_for_status=True,
-                                     headers=headers) as session:
-        async with session.get(url) as response:
-            return await response.json()
-
-
-async def get_category(access_token: str,
-                       category_id: Union[str, int]) -> Dict[str, Any]:
-    url = f'https://api.moltin.com/v2/categories/{category_id}'
-    headers = {
-        'Authorization': f'Bearer {access_token}'
-    }
-    async with aiohttp.ClientSession(raise_for_status=True,
-                                     headers=headers) as session:
-        async with session.get(url) as response:
-            return await response.json()
-
-
-async def get_promotions(access_token: str) -> Dict[str, Any]:
-    url = 'https://api.moltin.com/v2/promotions'
-    headers = {
-        'Authorization': f'Bearer {access_token}'
-    }
-    async with aiohttp.ClientSession(raise_for_status=True,
-                                     headers=headers) as session:
-        async with session.get(url) as response:
-            return await response.json()
+        if default:
+            field_description['data'].update({'default': default})
+        return await self._request('POST', url, headers=headers,
+                                   json=field_description)
+
+    async def create_flow_entry(
+            self, access_token: str, flow_slug: str,
+            fields_slug_per_value: Dict[str, str]) -> Dict[str, str]:
+        url = self._url(f'/v2/flows/{flow_slug}/entries')
+        headers = self._auth_headers(access_token)
+        entry_description = {
+            'data': {
+                'type': 'entry',
+                **fields_slug_per_value
+            }
+        }
+        return await self._request('POST', url, headers=headers,
+                                   json=entry_description)
+
+    async def get_entries(self, access_token: str, flow_slug: str,
+                          next_page_url: str = None, offset: int = 0,
+                          limit: int = 100) -> Dict[str, Any]:
+        url = next_page_url or self._url(f'/v2/flows/{flow_slug}/entries')
+        headers = self._auth_headers(access_token)
+        payload = {
+            'page[limit]': limit,
+        }
+        if offset and not next_page_url:
+            payload['page[offset]'] = offset
+        return await self._request('GET', url, headers=headers,
+                                   params=payload)
+
+    async def get_available_entries(
+            self, access_token: str, flow_slug: str,
+            limit: int = 100, concurrency: int = 4) -> List[Dict[str, Any]]:
+        entries = await self.get_entries(access_token, flow_slug=flow_slug,
+                                         limit=limit)
+        available_entries = list(entries['data'])
+
+        total_pages = entries.get('meta', {}).get('page', {}).get('total')
+        if total_pages is None:
+            while next_page_url := entries['links']['next']:
+                entries = await self.get_entries(access_token,
+                                                 flow_slug=flow_slug,
+                                                 next_page_url=next_page_url,
+                                                 limit=limit)
+                available_entries += entries['data']
+            return available_entries
+
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def get_page(page: int) -> List[Dict[str, Any]]:
+            async with semaphore:
+                page_entries = await self.get_entries(
+                    access_token, flow_slug=flow_slug,
+                    offset=(page - 1) * limit, limit=limit
+                )
+            return page_entries['data']
+
+        pages = await asyncio.gather(*map(get_page,
+                                          range(2, total_pages + 1)))
+        for page_entries in pages:
+            available_entries += page_entries
+        return available_entries
+
+    async def get_categories(self, access_token: str) -> Dict[str, Any]:
+        url = self._url('/v2/categories')
+        headers = self._auth_headers(access_token)
+        return await self._request('GET', url, headers=headers)
+
+    async def get_category(self, access_token: str,
+                           category_id: Union[str, int]) -> Dict[str, Any]:
+        url = self._url(f'/v2/categories/{category_id}')
+        headers = self._auth_headers(access_token)
+        return await self._request('GET', url, headers=headers)
+
+    async def get_promotions(self, access_token: str) -> Dict[str, Any]:
+        url = self._url('/v2/promotions')
+        headers = self._auth_headers(access_token)
+        return await self._request('GET', url, headers=headers)
+
+
+class MoltinTokenManager:
+    """Keeps the Moltin access token of the process fresh.
+
+    All callers share one in-flight token request. Once :meth:`start` is
+    called, the token is renewed in background ``refresh_margin`` seconds
+    before it expires, so handlers never wait for the OAuth round trip.
+    """
+
+    def __init__(self, moltin: MoltinClient, client_id: str,
+                 client_secret: str, refresh_margin: float = 60,
+                 retry_interval: float = 5):
+        self.moltin = moltin
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.refresh_margin = refresh_margin
+        self.retry_interval = retry_interval
+        self._access_token: Optional[str] = None
+        self._expires_at = 0.0
+        self._refresh_task: Optional[asyncio.Task] = None
+        self._background_task: Optional[asyncio.Task] = None
+
+    @property
+    def expires_at(self) -> float:
+        return self._expires_at
+
+    def _is_valid(self) -> bool:
+        return (self._access_token is not None
+                and time.time() < self._expires_at)
+
+    def _needs_refresh(self) -> bool:
+        return time.time() >= self._expires_at - self.refresh_margin
+
+    async def _fetch_token(self) -> str:
+        access_token = await self.moltin.get_access_token(self.client_id,
+                                                          self.client_secret)
+        self._access_token = access_token['access_token']
+        self._expires_at = float(access_token['expires'])
+        logger.debug('Токен Moltin обновлен')
+        return self._access_token
+
+    @staticmethod
+    def _log_refresh_error(task: asyncio.Task) -> None:
+        if not task.cancelled() and (err := task.exception()):
+            logger.error(f'Не удалось обновить токен Moltin: {err}')
+
+    def _start_refresh(self) -> asyncio.Task:
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self._fetch_token())
+            self._refresh_task.add_done_callback(self._log_refresh_error)
+        return self._refresh_task
+
+    async def refresh(self) -> str:
+        return await asyncio.shield(self._start_refresh())
+
+    async def get_token(self) -> str:
+        if not self._is_valid():
+            return await self.refresh()
+        if self._needs_refresh():
+            self._start_refresh()
+        return self._access_token
+
+    async def _refresh_periodically(self) -> None:
+        while True:
+            delay = self._expires_at - self.refresh_margin - time.time()
+            await asyncio.sleep(max(delay, 0))
+            try:
+                await self.refresh()
+            except Exception as err:
+                logger.warning(f'Токен Moltin будет обновлен повторно через '
+                               f'{self.retry_interval} с: {err!r}')
+                await asyncio.sleep(self.retry_interval)
+
+    async def start(self) -> None:
+        if not self._is_valid():
+            await self.refresh()
+        if self._background_task is None or self._background_task.done():
+            self._background_task = asyncio.create_task(
+                self._refresh_periodically()
+            )
+
+    async def close(self) -> None:
+        if self._background_task is not None:
+            self._background_task.cancel()
+            try:
+                await self._background_task
+            except asyncio.CancelledError:
+                pass
+        self._background_task = None
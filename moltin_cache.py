@@ -0,0 +1,376 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    Hashable,
+    List,
+    MutableMapping,
+    Optional,
+    Tuple,
+    Union
+)
+
+from telegram.ext import CallbackContext
+
+from moltin_api import MoltinClient, MoltinTokenManager
+
+logger = logging.getLogger(__file__)
+
+
+class AsyncTTLCache:
+    """Bounded LRU cache whose entries expire ``ttl`` seconds after write.
+
+    Concurrent misses of the same key share one loader call. A loaded
+    :obj:`None` is kept for ``negative_ttl`` seconds if it is given.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: 'OrderedDict[Hashable, Tuple[float, Any]]' = (
+            OrderedDict()
+        )
+        self._pending: Dict[Hashable, asyncio.Task] = {}
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def _lookup(self, key: Hashable) -> Tuple[bool, Any]:
+        try:
+            expires_at, value = self._data[key]
+        except KeyError:
+            return False, None
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            return False, None
+        self._data.move_to_end(key)
+        return True, value
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        found, value = self._lookup(key)
+        if found:
+            self.hits += 1
+            return value
+        self.misses += 1
+        return default
+
+    def set(self, key: Hashable, value: Any, ttl: float = None) -> None:
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    async def get_or_load(self, key: Hashable,
+                          loader: Callable[[], Awaitable[Any]],
+                          ttl: float = None,
+                          negative_ttl: float = None) -> Any:
+        found, value = self._lookup(key)
+        if found:
+            self.hits += 1
+            return value
+        self.misses += 1
+
+        if not (task := self._pending.get(key)):
+            task = asyncio.create_task(loader())
+            self._pending[key] = task
+            try:
+                value = await asyncio.shield(task)
+            finally:
+                self._pending.pop(key, None)
+            if value is None and negative_ttl is not None:
+                ttl = negative_ttl
+            self.set(key, value, ttl)
+            return value
+        return await asyncio.shield(task)
+
+    def invalidate(self, key: Hashable) -> None:
+        self._data.pop(key, None)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        requests = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / requests if requests else 0.0,
+        }
+
+
+class MoltinCatalogCache:
+    """Read-through cache for Moltin catalog resources.
+
+    Products, categories and SKU lookups change a few times a day, so they
+    are kept in memory with separate TTLs per resource.
+    """
+
+    def __init__(self, moltin: MoltinClient, maxsize: int = 1024,
+                 product_ttl: float = 600, category_ttl: float = 3600,
+                 categories_ttl: float = 3600, sku_ttl: float = 600):
+        self.moltin = moltin
+        self.products = AsyncTTLCache(maxsize, product_ttl)
+        self.categories = AsyncTTLCache(maxsize, category_ttl)
+        self.categories_list = AsyncTTLCache(1, categories_ttl)
+        self.skus = AsyncTTLCache(maxsize, sku_ttl)
+
+    async def get_product(self, access_token: str,
+                          product_id: Union[str, int]) -> Dict[str, Any]:
+        return await self.products.get_or_load(
+            str(product_id),
+            lambda: self.moltin.get_product(access_token, product_id)
+        )
+
+    async def get_category(self, access_token: str,
+                           category_id: Union[str, int]) -> Dict[str, Any]:
+        return await self.categories.get_or_load(
+            str(category_id),
+            lambda: self.moltin.get_category(access_token, category_id)
+        )
+
+    async def get_categories(self, access_token: str) -> Dict[str, Any]:
+        return await self.categories_list.get_or_load(
+            'categories',
+            lambda: self.moltin.get_categories(access_token)
+        )
+
+    async def get_product_by_sku(self, access_token: str,
+                                 product_sku: str) -> Dict[str, Any]:
+        return await self.skus.get_or_load(
+            product_sku,
+            lambda: self.moltin.get_product_by_sku(access_token, product_sku)
+        )
+
+    async def get_products_by_skus(
+            self, access_token: str,
+            products_sku: List[str]) -> List[Dict[str, Any]]:
+        products_per_sku = {}
+        missing_products_sku = []
+        for product_sku in products_sku:
+            if product := self.skus.get(product_sku):
+                products_per_sku[product_sku] = product['data'][0]
+            else:
+                missing_products_sku.append(product_sku)
+
+        if missing_products_sku:
+            products = await self.moltin.get_products_by_skus(
+                access_token, missing_products_sku
+            )
+            for product in products:
+                self.skus.set(product['sku'], {'data': [product]})
+                products_per_sku[product['sku']] = product
+
+        return [products_per_sku[product_sku] for product_sku in products_sku
+                if product_sku in products_per_sku]
+
+    def invalidate_product(self, product_id: Union[str, int],
+                           product_sku: Optional[str] = None) -> None:
+        self.products.invalidate(str(product_id))
+        if product_sku:
+            self.skus.invalidate(product_sku)
+
+    def invalidate_category(self, category_id: Union[str, int]) -> None:
+        self.categories.invalidate(str(category_id))
+        self.categories_list.clear()
+
+    def invalidate_all(self) -> None:
+        for cache in (self.products, self.categories,
+                      self.categories_list, self.skus):
+            cache.clear()
+
+    def stats(self) -> Dict[str, Dict[str, Union[int, float]]]:
+        return {
+            'products': self.products.stats(),
+            'categories': self.categories.stats(),
+            'categories_list': self.categories_list.stats(),
+            'skus': self.skus.stats(),
+        }
+
+
+class FlowEntriesSnapshot:
+    """In-memory copy of all entries of a Moltin flow.
+
+    The snapshot is refreshed on schedule through :meth:`refresh_job` or on
+    demand through :meth:`refresh`. If a refresh fails, readers keep getting
+    the previous entries. When ``index_factory`` is given, an index over the
+    entries is rebuilt every time they change.
+    """
+
+    def __init__(self, moltin: MoltinClient,
+                 moltin_tokens: MoltinTokenManager, flow_slug: str,
+                 ttl: float = 600,
+                 index_factory: Callable[[List[Dict[str, Any]]], Any] = None):
+        self.moltin = moltin
+        self.moltin_tokens = moltin_tokens
+        self.flow_slug = flow_slug
+        self.ttl = ttl
+        self.index_factory = index_factory
+        self.entries: List[Dict[str, Any]] = []
+        self.index: Any = None
+        self.updated_at: Optional[float] = None
+        self._refresh_task: Optional[asyncio.Task] = None
+
+    def is_stale(self) -> bool:
+        return (self.updated_at is None
+                or time.monotonic() - self.updated_at >= self.ttl)
+
+    async def _load_entries(self) -> List[Dict[str, Any]]:
+        moltin_token = await self.moltin_tokens.get_token()
+        entries = await self.moltin.get_available_entries(
+            moltin_token, flow_slug=self.flow_slug
+        )
+        if self.index_factory and (self.index is None
+                                   or entries != self.entries):
+            self.index = self.index_factory(entries)
+        self.entries = entries
+        self.updated_at = time.monotonic()
+        logger.info(f'Записи потока {self.flow_slug} обновлены: '
+                    f'{len(entries)}')
+        return entries
+
+    async def refresh(self) -> List[Dict[str, Any]]:
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self._load_entries())
+        return await asyncio.shield(self._refresh_task)
+
+    async def get(self) -> List[Dict[str, Any]]:
+        if not self.is_stale():
+            return self.entries
+        try:
+            return await self.refresh()
+        except Exception as err:
+            if self.updated_at is None:
+                raise
+            logger.error(f'Не удалось обновить записи потока '
+                         f'{self.flow_slug}: {err}')
+            return self.entries
+
+    async def get_index(self) -> Any:
+        await self.get()
+        return self.index
+
+    async def refresh_job(self, context: CallbackContext.DEFAULT_TYPE) -> None:
+        try:
+            await self.refresh()
+        except Exception as err:
+            logger.error(f'Не удалось обновить записи потока '
+                         f'{self.flow_slug}: {err}')
+
+
+class CustomerCache:
+    """Moltin customers resolved for a chat, kept in ``context.user_data``.
+
+    Once a customer is found or created for an email, checkout uses the
+    stored record right away. Records older than ``revalidate_after``
+    seconds are checked against Moltin in background; a customer that no
+    longer exists is dropped, so the next checkout asks for the email again.
+    """
+
+    user_data_key = 'customer'
+
+    def __init__(self, moltin: MoltinClient,
+                 moltin_tokens: MoltinTokenManager,
+                 revalidate_after: float = 3600):
+        self.moltin = moltin
+        self.moltin_tokens = moltin_tokens
+        self.revalidate_after = revalidate_after
+        self.hits = 0
+        self.misses = 0
+        self._pending: Dict[str, asyncio.Task] = {}
+
+    def _store(self, user_data: MutableMapping[str, Any],
+               customer: Dict[str, Any]) -> Dict[str, Any]:
+        customer_data = customer['data']
+        if isinstance(customer_data, list):
+            customer_data = customer_data[0]
+        record = {
+            'id': customer_data['id'],
+            'email': customer_data['email'],
+            'validated_at': time.time(),
+        }
+        user_data[self.user_data_key] = record
+        return record
+
+    def get_cached(self, user_data: MutableMapping[str, Any],
+                   email: Optional[str]) -> Optional[Dict[str, Any]]:
+        record = user_data.get(self.user_data_key)
+        if not email or not record or record['email'] != email:
+            return None
+        return record
+
+    async def _revalidate(self, user_data: MutableMapping[str, Any],
+                          email: str) -> None:
+        moltin_token = await self.moltin_tokens.get_token()
+        customer = await self.moltin.get_customer_by_email(moltin_token,
+                                                           email)
+        if customer['data']:
+            self._store(user_data, customer)
+        elif self.get_cached(user_data, email):
+            del user_data[self.user_data_key]
+            logger.info(f'Покупатель {email} не найден в Moltin')
+
+    def _log_revalidation_error(self, task: asyncio.Task) -> None:
+        if not task.cancelled() and (err := task.exception()):
+            logger.error(f'Не удалось проверить покупателя: {err}')
+
+    def _schedule_revalidation(self, user_data: MutableMapping[str, Any],
+                               email: str) -> None:
+        if (task := self._pending.get(email)) and not task.done():
+            return
+        task = asyncio.create_task(self._revalidate(user_data, email))
+        task.add_done_callback(self._log_revalidation_error)
+        task.add_done_callback(lambda _: self._pending.pop(email, None))
+        self._pending[email] = task
+
+    async def get_customer(
+            self, user_data: MutableMapping[str, Any], access_token: str,
+            email: Optional[str]) -> Optional[Dict[str, Any]]:
+        if record := self.get_cached(user_data, email):
+            self.hits += 1
+            if time.time() - record['validated_at'] >= self.revalidate_after:
+                self._schedule_revalidation(user_data, email)
+            return record
+        self.misses += 1
+        if not email:
+            return None
+
+        customer = await self.moltin.get_customer_by_email(access_token,
+                                                           email)
+        if not customer['data']:
+            return None
+        return self._store(user_data, customer)
+
+    async def get_or_create_customer(
+            self, user_data: MutableMapping[str, Any], access_token: str,
+            email: str) -> Dict[str, Any]:
+        if record := self.get_cached(user_data, email):
+            self.hits += 1
+            return record
+        self.misses += 1
+        customer = await self.moltin.get_or_create_customer_by_email(
+            access_token, email
+        )
+        return self._store(user_data, customer)
+
+    async def close(self) -> None:
+        tasks = list(self._pending.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'pending_revalidations': len(self._pending),
+        }
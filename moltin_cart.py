@@ -0,0 +1,102 @@
+import time
+from typing import Any, Dict, MutableMapping, Union
+
+from moltin_api import MoltinClient
+
+CART_MIRROR_KEY = 'cart_mirror'
+
+
+class CartMirror:
+    """Write-through copy of Moltin carts kept in ``context.user_data``.
+
+    Moltin answers every cart mutation with the full list of cart items, so
+    the mirror is refreshed from those responses and cart screens are drawn
+    without another ``get_cart_items`` call. The cart is fetched again only
+    when the mirror is older than ``ttl`` seconds or a mutation failed.
+    """
+
+    def __init__(self, moltin: MoltinClient, ttl: float = 300):
+        self.moltin = moltin
+        self.ttl = ttl
+        self.hits = 0
+        self.syncs = 0
+
+    @staticmethod
+    def _store(user_data: MutableMapping[str, Any],
+               cart_items: Dict[str, Any]) -> Dict[str, Any]:
+        mirror = user_data.get(CART_MIRROR_KEY) or {}
+        user_data[CART_MIRROR_KEY] = {
+            'items': cart_items,
+            'version': mirror.get('version', 0) + 1,
+            'synced_at': time.time(),
+            'dirty': False,
+        }
+        return cart_items
+
+    def is_fresh(self, user_data: MutableMapping[str, Any]) -> bool:
+        mirror = user_data.get(CART_MIRROR_KEY)
+        return bool(mirror) and not mirror['dirty'] and (
+            time.time() - mirror['synced_at'] < self.ttl
+        )
+
+    @staticmethod
+    def invalidate(user_data: MutableMapping[str, Any]) -> None:
+        if mirror := user_data.get(CART_MIRROR_KEY):
+            mirror['dirty'] = True
+
+    @staticmethod
+    def drop(user_data: MutableMapping[str, Any]) -> None:
+        user_data.pop(CART_MIRROR_KEY, None)
+
+    async def sync(self, user_data: MutableMapping[str, Any],
+                   access_token: str,
+                   cart_id: Union[str, int]) -> Dict[str, Any]:
+        self.syncs += 1
+        cart_items = await self.moltin.get_cart_items(access_token, cart_id)
+        return self._store(user_data, cart_items)
+
+    async def get_items(self, user_data: MutableMapping[str, Any],
+                        access_token: str,
+                        cart_id: Union[str, int]) -> Dict[str, Any]:
+        if self.is_fresh(user_data):
+            self.hits += 1
+            return user_data[CART_MIRROR_KEY]['items']
+        return await self.sync(user_data, access_token, cart_id)
+
+    async def add_item(self, user_data: MutableMapping[str, Any],
+                       access_token: str, cart_id: Union[str, int],
+                       item_id: Union[str, int],
+                       item_quantity: Union[str, int]) -> Dict[str, Any]:
+        if CART_MIRROR_KEY not in user_data:
+            await self.moltin.get_or_create_cart(access_token, cart_id)
+        try:
+            cart_items = await self.moltin.add_cart_item(
+                access_token, cart_id, item_id, item_quantity
+            )
+        except Exception:
+            self.invalidate(user_data)
+            raise
+        return self._store(user_data, cart_items)
+
+    async def remove_item(self, user_data: MutableMapping[str, Any],
+                          access_token: str, cart_id: Union[str, int],
+                          item_id: Union[str, int]) -> Dict[str, Any]:
+        try:
+            cart_items = await self.moltin.remove_cart_item(
+                access_token, cart_id, item_id
+            )
+        except Exception:
+            self.invalidate(user_data)
+            raise
+        return self._store(user_data, cart_items)
+
+    async def delete(self, user_data: MutableMapping[str, Any],
+                     access_token: str, cart_id: Union[str, int]) -> bool:
+        self.drop(user_data)
+        return await self.moltin.delete_cart(access_token, cart_id)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'hits': self.hits,
+            'syncs': self.syncs,
+        }
@@ -0,0 +1,157 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from pathlib import Path
+from types import FrameType
+from typing import List, NamedTuple, Optional
+
+logger = logging.getLogger(__file__)
+
+
+class ProfileReport(NamedTuple):
+    samples_count: int
+    blocked_samples_count: int
+    slow_callbacks: List[str]
+    stacks_path: Path
+    report_path: Path
+
+
+def collapse_stack(frame: Optional[FrameType]) -> str:
+    frames = []
+    while frame is not None:
+        code = frame.f_code
+        frames.append(f'{code.co_name} '
+                      f'({Path(code.co_filename).name}:{code.co_firstlineno})')
+        frame = frame.f_back
+    return ';'.join(reversed(frames))
+
+
+class SlowCallbacksHandler(logging.Handler):
+    """Collects asyncio debug warnings about callbacks that blocked the loop.
+    """
+
+    def __init__(self):
+        super().__init__(level=logging.WARNING)
+        self.messages: List[str] = []
+
+    def emit(self, record: logging.LogRecord) -> None:
+        message = record.getMessage()
+        if message.startswith('Executing'):
+            self.messages.append(message)
+
+
+class LoopProfiler:
+    """Time-boxed sampling profiler of a running event loop.
+
+    A daemon thread samples the stack of the loop thread every ``interval``
+    seconds and counts the collapsed stacks, which can be turned into a
+    flamegraph by ``flamegraph.pl`` or speedscope. A heartbeat coroutine
+    tells the thread when the loop is blocked for longer than
+    ``slow_callback_duration``; stacks sampled at that moment are reported
+    separately. For the same period asyncio debug mode is switched on, so
+    its slow callback warnings are added to the report.
+    """
+
+    def __init__(self, interval: float = 0.005,
+                 slow_callback_duration: float = 0.1):
+        self.interval = interval
+        self.slow_callback_duration = slow_callback_duration
+        self.stacks: Counter = Counter()
+        self.blocked_stacks: Counter = Counter()
+        self._last_heartbeat = time.monotonic()
+        self._stopped = threading.Event()
+
+    def _sample(self, loop_thread_id: int) -> None:
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(loop_thread_id)
+            stack = collapse_stack(frame)
+            self.stacks[stack] += 1
+            lag = time.monotonic() - self._last_heartbeat
+            if lag > self.slow_callback_duration:
+                self.blocked_stacks[stack] += 1
+
+    async def _beat(self) -> None:
+        while True:
+            self._last_heartbeat = time.monotonic()
+            await asyncio.sleep(self.interval)
+
+    async def run(self, duration: float) -> List[str]:
+        loop = asyncio.get_running_loop()
+        asyncio_logger = logging.getLogger('asyncio')
+        slow_callbacks_handler = SlowCallbacksHandler()
+        debug = loop.get_debug()
+        slow_callback_duration = loop.slow_callback_duration
+
+        asyncio_logger.addHandler(slow_callbacks_handler)
+        loop.slow_callback_duration = self.slow_callback_duration
+        loop.set_debug(True)
+        heartbeat = asyncio.create_task(self._beat())
+        sampler = threading.Thread(target=self._sample,
+                                   args=(threading.get_ident(),),
+                                   name='loop-profiler', daemon=True)
+        sampler.start()
+        try:
+            await asyncio.sleep(duration)
+        finally:
+            self._stopped.set()
+            heartbeat.cancel()
+            loop.set_debug(debug)
+            loop.slow_callback_duration = slow_callback_duration
+            asyncio_logger.removeHandler(slow_callbacks_handler)
+            await asyncio.get_running_loop().run_in_executor(None,
+                                                              sampler.join)
+        return slow_callbacks_handler.messages
+
+    def write_stacks(self, path: Path) -> None:
+        with open(path, 'w', encoding='utf-8') as stacks_file:
+            for stack, count in self.stacks.most_common():
+                stacks_file.write(f'{stack} {count}\n')
+
+    def write_report(self, path: Path, duration: float,
+                     slow_callbacks: List[str], top: int = 20) -> None:
+        samples_count = sum(self.stacks.values())
+        lines = [
+            f'Длительность: {duration} с, сэмплов: {samples_count}, '
+            f'интервал: {self.interval * 1000:.1f} мс',
+            '',
+            f'Колбэки дольше {self.slow_callback_duration * 1000:.0f} мс: '
+            f'{len(slow_callbacks)}',
+            *slow_callbacks,
+            '',
+            f'Стеки, пока цикл событий был заблокирован '
+            f'(~{self.interval * 1000:.1f} мс на сэмпл):',
+        ]
+        for stack, count in self.blocked_stacks.most_common(top):
+            frames = stack.split(';')
+            lines += [f'{count} сэмплов:', *[f'    {frame}'
+                                            for frame in frames[-15:]], '']
+        with open(path, 'w', encoding='utf-8') as report_file:
+            report_file.write('\n'.join(lines) + '\n')
+
+
+async def profile_event_loop(duration: float, output_dir: Path,
+                             interval: float = 0.005,
+                             slow_callback_duration: float = 0.1
+                             ) -> ProfileReport:
+    profiler = LoopProfiler(interval, slow_callback_duration)
+    logger.info(f'Профилирование цикла событий на {duration} с')
+    slow_callbacks = await profiler.run(duration)
+
+    output_dir.mkdir(parents=True, exist_ok=True)
+    timestamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+    stacks_path = output_dir / f'profile-{timestamp}.folded'
+    report_path = output_dir / f'slow-callbacks-{timestamp}.txt'
+    profiler.write_stacks(stacks_path)
+    profiler.write_report(report_path, duration, slow_callbacks)
+    logger.info(f'Профиль записан в {stacks_path}, отчет - в {report_path}')
+    return ProfileReport(
+        samples_count=sum(profiler.stacks.values()),
+        blocked_samples_count=sum(profiler.blocked_stacks.values()),
+        slow_callbacks=slow_callbacks,
+        stacks_path=stacks_path,
+        report_path=report_path,
+    )
@@ -1,11 +1,15 @@
+import asyncio
+import hashlib
 import logging
-import pickle
-from collections import defaultdict
-from copy import deepcopy
-from typing import Dict, Optional, Tuple, Any, cast
+import time
+from collections import OrderedDict, defaultdict
+from contextlib import suppress
+from typing import (
+    Any, Callable, Dict, Iterable, Optional, Tuple, cast
+)
 
 import aioredis
-from telegram.ext import BasePersistence, PersistenceInput
+from telegram.ext import BasePersistence, CallbackContext, PersistenceInput
 from telegram.ext._contexttypes import ContextTypes
 from telegram.ext._utils.types import (
     BD, CD, UD,
@@ -14,10 +18,121 @@ from telegram.ext._utils.types import (
     ConversationKey
 )
 
+from metrics import REGISTRY, MetricsRegistry, track
+from serializers import Serializer
+
 logger = logging.getLogger(__file__)
 
+MISSING = object()
+SWEEP_BATCH_SIZE = 500
+RESUBSCRIBE_DELAY = 5
+
+
+def format_redis_url(url: str) -> str:
+    prefix = 'redis://'
+    if url.startswith(prefix):
+        return url
+    return f'{prefix}{url}'
+
+
+def create_redis(url: str, max_connections: int = 50,
+                 pool_timeout: float = 5, socket_timeout: float = 5,
+                 socket_connect_timeout: float = 5,
+                 health_check_interval: int = 30) -> aioredis.Redis:
+    """Creates a client with a bounded pool to share across the process.
+
+    When all ``max_connections`` are busy, a command waits up to
+    ``pool_timeout`` seconds for a free connection instead of failing.
+    """
+    connection_pool = aioredis.BlockingConnectionPool.from_url(
+        format_redis_url(url),
+        max_connections=max_connections,
+        timeout=pool_timeout,
+        socket_timeout=socket_timeout,
+        socket_connect_timeout=socket_connect_timeout,
+        socket_keepalive=True,
+        health_check_interval=health_check_interval,
+    )
+    return aioredis.Redis(connection_pool=connection_pool)
+
+
+async def close_redis(redis: aioredis.Redis) -> None:
+    await redis.close()
+    await redis.connection_pool.disconnect()
+
+
+async def publish_bot_data(redis: aioredis.Redis, main_key: str,
+                           bot_data_key: str,
+                           mapping: Dict[str, bytes]) -> int:
+    """Writes encoded ``bot_data`` fields and notifies the running bots.
+
+    Only the fields that differ from the stored ones are written. They are
+    stamped with a new version in ``<key>:versions`` and the version is
+    published to ``<key>:updates`` in the same transaction, see
+    :class:`RedisPersistence`. Returns the version or ``0`` if nothing has
+    changed.
+    """
+    key = f'{main_key}:{bot_data_key}'
+    with track('redis_command', command='hmget'):
+        stored = await redis.hmget(key, list(mapping))
+    changes = {
+        field: data_bytes
+        for (field, data_bytes), stored_bytes in zip(mapping.items(), stored)
+        if data_bytes != stored_bytes
+    }
+    if not changes:
+        return 0
+    with track('redis_command', command='incr'):
+        version = await redis.incr(f'{key}:version')
+    async with redis.pipeline(transaction=True) as pipeline:
+        pipeline.hset(key, mapping=changes)
+        pipeline.hset(f'{key}:versions',
+                      mapping=dict.fromkeys(changes, version))
+        pipeline.publish(f'{key}:updates', version)
+        with track('redis_command', command='pipeline'):
+            await pipeline.execute()
+    return version
+
 
 class RedisPersistence(BasePersistence[UD, CD, BD]):
+    """Persistence that keeps every entry under its own Redis key or field.
+
+    ``user_data`` and ``chat_data`` are hashes ``<main_key>:<*_data_key>``
+    with a field per user or chat, ``bot_data`` is a hash with a field per
+    top-level key, ``conversations`` is a hash with a field per handler and
+    ``callback_data`` is a plain key. A blob stored under ``main_key`` by
+    earlier versions is split into this layout on the first load. Values
+    are encoded by :class:`serializers.Serializer`; entries written in an
+    older format are rewritten on the next flush after they are loaded.
+
+    ``user_data`` and ``chat_data`` are loaded lazily: ``get_user_data``
+    and ``get_chat_data`` return nothing, and a user's or a chat's entry is
+    read by ``refresh_*_data`` before the first update from them is
+    handled. At most ``max_loaded_entries`` users and chats are kept
+    loaded; the least recently used ones, and the ones idle for longer
+    than ``idle_ttl`` seconds, are handed to :attr:`evict_callback` to
+    free them from memory. When ``storage_ttl`` is set, the time of the
+    last update of every entry is kept in the sorted set
+    ``<main_key>:<*_data_key>:last_seen``, and :meth:`sweep` strips
+    entries idle for longer than ``storage_ttl`` seconds in Redis down to
+    their ``persistent_keys``.
+
+    With ``listen_bot_data_updates`` the persistence subscribes to
+    ``<main_key>:<bot_data_key>:updates``. When :func:`publish_bot_data`
+    announces a new version, the fields stamped with it in
+    ``<main_key>:<bot_data_key>:versions`` are read, and
+    :meth:`refresh_bot_data` swaps them into ``bot_data`` before the next
+    update is handled. Copies of ``bot_data`` taken before the swap do not
+    write the old values back.
+
+    Only digests of the stored entries are kept in memory: ``get_*`` hand
+    out the freshly decoded data without copying it, and an update that
+    serializes to the same digest is not written. Changed entries are
+    written in one MULTI pipeline: right away if :attr:`flush_interval` is
+    not set, otherwise every ``flush_interval`` seconds or as soon as
+    ``flush_max_changes`` entries have changed. :meth:`flush` writes
+    everything that is left.
+    """
 
     def __init__(
             self,
@@ -32,215 +147,588 @@ class RedisPersistence(BasePersistence[UD, CD, BD]):
             store_data: PersistenceInput = None,
             on_flush: bool = False,
             update_interval: float = 60,
+            flush_interval: float = None,
+            flush_max_changes: int = 500,
             context_types: ContextTypes[Any, UD, CD, BD] = None,
+            redis: aioredis.Redis = None,
+            serializer: Serializer = None,
+            max_loaded_entries: int = 10000,
+            idle_ttl: float = None,
+            storage_ttl: float = None,
+            persistent_keys: Iterable[str] = (),
+            listen_bot_data_updates: bool = False,
+            registry: MetricsRegistry = REGISTRY,
     ):
         super().__init__(store_data=store_data,
                          update_interval=update_interval)
         self.url = url
+        self._owns_redis = redis is None
+        self.redis = redis or create_redis(url)
+        self.serializer = serializer or Serializer()
         self.main_key = main_key
         self.bot_data_key = bot_data_key
         self.user_data_key = user_data_key
         self.callback_data_key = callback_data_key
         self.chat_data_key = chat_data_key
         self.conversations_key = conversations_key
-        self._initial_data = initial_data
+        self._initial_data = initial_data or {}
+        self._legacy_data_checked = False
+        self.max_loaded_entries = max_loaded_entries
+        self.idle_ttl = idle_ttl
+        self.storage_ttl = storage_ttl
+        self.persistent_keys = frozenset(persistent_keys)
+        self._loaded_entries: Dict[str, OrderedDict] = {
+            'user_data': OrderedDict(),
+            'chat_data': OrderedDict(),
+        }
+        self._loading: Dict[Tuple[str, int], asyncio.Task] = {}
+        self._last_seen_seeded = False
+        self.evict_callback: Optional[Callable[[str, int], bool]] = None
+        self.listen_bot_data_updates = listen_bot_data_updates
+        self.bot_data_version = 0
+        self._bot_data_updates: Dict[str, bytes] = {}
+        self._stale_digests: Dict[str, Optional[bytes]] = {}
+        self._listener: Optional[asyncio.Task] = None
+        self._listener_stopped = False
+        self.evicted_entries = registry.counter(
+            'persistence_evicted_entries_total',
+            'Users and chats freed from memory or stripped in Redis.',
+            ('data', 'reason')
+        )
+        self.loaded_entries = registry.gauge(
+            'persistence_loaded_entries',
+            'Users and chats loaded in memory.', ('data',)
+        )
+        self.counters: Dict[str, int] = defaultdict(int)
         self.on_flush = on_flush
-        self.user_data: Optional[Dict[int, UD]] = None
-        self.chat_data: Optional[Dict[int, CD]] = None
-        self.bot_data: Optional[BD] = None
-        self.callback_data: Optional[CDCData] = None
+        self.flush_interval = flush_interval
+        self.flush_max_changes = flush_max_changes
+        self._digests: Dict[str, Dict[str, bytes]] = {
+            data_key: {} for data_key in self._get_hash_keys()
+        }
+        self._callback_data_digest: Optional[bytes] = None
+        self._changes: Dict[str, Dict[str, Optional[bytes]]] = {}
+        self._callback_data_change: Optional[bytes] = None
+        self._last_seen: Dict[str, Dict[str, float]] = {}
+        self._reset_changes()
+        self._flush_lock: Optional[asyncio.Lock] = None
+        self._flush_requested: Optional[asyncio.Event] = None
+        self._flusher: Optional[asyncio.Task] = None
+        self._flusher_stopped = False
         self.conversations: Optional[Dict[str, Dict[Tuple, object]]] = None
         self.context_types = cast(ContextTypes[Any, UD, CD, BD],
                                   context_types or ContextTypes())
 
-    def _format_redis_url(self) -> str:
-        prefix = 'redis://'
-        if self.url.startswith(prefix):
-            return self.url
-        return f'{prefix}{self.url}'
-
-    async def _redis_pool_set(self, key: str, data: bytes) -> None:
-        connection = aioredis.from_url(self._format_redis_url())
-        await connection.set(key, data)
+    def _get_key(self, data_key: str) -> str:
+        return f'{self.main_key}:{data_key}'
 
-    async def _redis_pool_get(self, key: str) -> bytes:
-        connection = aioredis.from_url(self._format_redis_url())
-        data = await connection.get(key)
-        return data
+    def _get_hash_keys(self) -> Tuple[str, ...]:
+        return (self.user_data_key, self.chat_data_key, self.bot_data_key,
+                self.conversations_key)
 
-    async def _perform_initialization(self) -> None:
-        valid_keys = ('bot_data', 'user_data', 'chat_data')
-        initial_data = {}
-        for key, value in self._initial_data.items():
-            if key not in valid_keys or not isinstance(value, dict):
-                continue
-            initial_data[key] = value
+    def _get_entry_keys(self) -> Tuple[Tuple[str, str], ...]:
+        return (('user_data', self.user_data_key),
+                ('chat_data', self.chat_data_key))
 
-        data_bytes = await self._redis_pool_get(self.main_key)
-        if data_bytes is None:
-            self.conversations = {}
-            self.user_data = initial_data.get('user_data', defaultdict(dict))
-            self.chat_data = initial_data.get('chat_data', defaultdict(dict))
-            self.bot_data = initial_data.get('bot_data', {})
-        else:
-            db_data = pickle.loads(data_bytes)
-            self.user_data = defaultdict(
-                dict, db_data.get(self.user_data_key, {})
-            )
-            self.user_data.update(initial_data.get('user_data', {}))
+    def _get_last_seen_key(self, data_key: str) -> str:
+        return self._get_key(f'{data_key}:last_seen')
 
-            self.chat_data = defaultdict(
-                dict, db_data.get(self.chat_data_key, {})
-            )
-            self.chat_data.update(initial_data.get('chat_data', {}))
+    def _get_bot_data_versions_key(self) -> str:
+        return self._get_key(f'{self.bot_data_key}:versions')
 
-            self.bot_data = db_data.get(self.bot_data_key, {})
-            self.bot_data.update(initial_data.get('bot_data', {}))
+    def _get_bot_data_channel(self) -> str:
+        return self._get_key(f'{self.bot_data_key}:updates')
 
-            self.conversations = initial_data.get(self.conversations_key, {})
+    @staticmethod
+    def _get_digest(data_bytes: bytes) -> bytes:
+        return hashlib.blake2b(data_bytes, digest_size=16).digest()
 
-        await self._dump_redis()
-        logger.info('БД успешно проинициализирована')
+    def _dumps(self, data: Any) -> bytes:
+        return self.serializer.dumps(data)
 
-    async def _load_redis(self) -> None:
-        if self._initial_data:
-            await self._perform_initialization()
-            self._initial_data = {}
+    def _loads(self, data_bytes: bytes) -> Any:
         try:
-            data_bytes = await self._redis_pool_get(self.main_key)
-            if data_bytes is None:
-                self.conversations = {}
-                self.user_data = defaultdict(dict)
-                self.chat_data = defaultdict(dict)
-                self.bot_data = {}
-                return
-            data = pickle.loads(data_bytes)
-            self.user_data = defaultdict(dict,
-                                         data.get(self.user_data_key, {}))
-            self.chat_data = defaultdict(dict,
-                                         data.get(self.chat_data_key, {}))
-            self.bot_data = data.get(self.bot_data_key, {})
-            self.conversations = data.get(self.conversations_key, {})
+            return self.serializer.loads(data_bytes)
         except Exception as exc:
             raise TypeError(
-                f"Something went wrong unpickling from Redis"
+                f"Something went wrong decoding data from Redis"
             ) from exc
 
-    async def _dump_redis(self) -> None:
-        data = {
-            self.bot_data_key: self.bot_data,
-            self.user_data_key: self.user_data,
-            self.chat_data_key: self.chat_data,
-            self.callback_data_key: self.callback_data,
-            self.conversations_key: self.conversations
+    async def _redis_pool_get(self, key: str) -> bytes:
+        with track('redis_command', command='get'):
+            data = await self.redis.get(key)
+        return data
+
+    async def _redis_pool_hset(self, key: str,
+                               mapping: Dict[str, bytes]) -> None:
+        if not mapping:
+            return
+        with track('redis_command', command='hset'):
+            await self.redis.hset(key, mapping=mapping)
+
+    async def _redis_pool_hget(self, key: str, field: str) -> bytes:
+        with track('redis_command', command='hget'):
+            data = await self.redis.hget(key, field)
+        return data
+
+    async def _redis_pool_hgetall(self, key: str) -> Dict[str, bytes]:
+        with track('redis_command', command='hgetall'):
+            data = await self.redis.hgetall(key)
+        return {field.decode(): value for field, value in data.items()}
+
+    async def _migrate_legacy_data(self) -> None:
+        """Splits the blob of the earlier versions into per-key entries.
+
+        Entries that already exist in the new layout are kept, so a menu
+        written by ``update_menu.py`` is not replaced by an older one.
+        """
+        if await self.redis.type(self.main_key) != b'string':
+            return
+        data = self._loads(await self._redis_pool_get(self.main_key))
+
+        hashes = {
+            self.user_data_key: data.get(self.user_data_key) or {},
+            self.chat_data_key: data.get(self.chat_data_key) or {},
+            self.bot_data_key: data.get(self.bot_data_key) or {},
+            self.conversations_key: data.get(self.conversations_key) or {},
         }
-        data_bytes = pickle.dumps(data)
-        await self._redis_pool_set(self.main_key, data_bytes)
+        async with self.redis.pipeline(transaction=True) as pipeline:
+            for data_key, entries in hashes.items():
+                for field, value in entries.items():
+                    pipeline.hsetnx(self._get_key(data_key), str(field),
+                                    self._dumps(value))
+            if (callback_data := data.get(self.callback_data_key)) is not None:
+                pipeline.set(self._get_key(self.callback_data_key),
+                             self._dumps(callback_data), nx=True)
+            pipeline.rename(self.main_key, self._get_key('legacy'))
+            with track('redis_command', command='pipeline'):
+                await pipeline.execute()
+        logger.info(f'Данные из {self.main_key} разделены по ключам, '
+                    f'старая запись сохранена в {self._get_key("legacy")}')
+
+    async def _check_legacy_data(self) -> None:
+        if not self._legacy_data_checked:
+            await self._migrate_legacy_data()
+            self._legacy_data_checked = True
+
+    async def _load_hash(self, data_key: str) -> Dict[str, Any]:
+        await self._check_legacy_data()
+        data = await self._redis_pool_hgetall(self._get_key(data_key))
+        self._digests[data_key] = {
+            field: self._get_digest(value) for field, value in data.items()
+        }
+        entries = {field: self._loads(value) for field, value in data.items()}
+        outdated_fields = [field for field, value in data.items()
+                           if not self.serializer.is_current(value)]
+        for field in outdated_fields:
+            self._stage_entry(data_key, field, entries[field])
+        if outdated_fields:
+            logger.info(f'Записей {data_key} в старом формате: '
+                        f'{len(outdated_fields)}, они будут перезаписаны')
+            await self._on_change()
+        return entries
+
+    async def _load_entry(self, data_key: str, entity_id: int) -> Any:
+        field = str(entity_id)
+        data_bytes = self._changes[data_key].get(field, MISSING)
+        if data_bytes is MISSING:
+            await self._check_legacy_data()
+            data_bytes = await self._redis_pool_hget(self._get_key(data_key),
+                                                     field)
+            if data_bytes is not None:
+                self._digests[data_key][field] = self._get_digest(data_bytes)
+        if data_bytes is None:
+            return None
+        value = self._loads(data_bytes)
+        if not self.serializer.is_current(data_bytes):
+            self._stage_entry(data_key, field, value)
+        return value
+
+    async def _refresh_entry(self, data_name: str, data_key: str,
+                             entity_id: int, data: Dict) -> None:
+        loaded_entries = self._loaded_entries[data_name]
+        if self.storage_ttl:
+            self._last_seen[data_key][str(entity_id)] = time.time()
+        if entity_id not in loaded_entries:
+            loading_key = (data_name, entity_id)
+            if not (loading := self._loading.get(loading_key)):
+                loading = asyncio.create_task(
+                    self._load_entry(data_key, entity_id)
+                )
+                self._loading[loading_key] = loading
+            try:
+                value = await loading
+            finally:
+                self._loading.pop(loading_key, None)
+            for key, item in (value or {}).items():
+                data.setdefault(key, item)
+        loaded_entries[entity_id] = time.monotonic()
+        loaded_entries.move_to_end(entity_id)
+        self._evict_entries(data_name, data_key)
+
+    def _evict_entries(self, data_name: str, data_key: str) -> None:
+        loaded_entries = self._loaded_entries[data_name]
+        idle_since = time.monotonic() - (self.idle_ttl or float('inf'))
+        while loaded_entries:
+            entity_id, last_seen = next(iter(loaded_entries.items()))
+            if len(loaded_entries) > self.max_loaded_entries:
+                reason = 'limit'
+            elif last_seen < idle_since:
+                reason = 'idle'
+            else:
+                break
+            if (self.evict_callback
+                    and not self.evict_callback(data_name, entity_id)):
+                loaded_entries[entity_id] = time.monotonic()
+                loaded_entries.move_to_end(entity_id)
+                break
+            del loaded_entries[entity_id]
+            self._digests[data_key].pop(str(entity_id), None)
+            self.evicted_entries.inc(data=data_name, reason=reason)
+            self.counters[f'{data_name}_evicted'] += 1
+        self.loaded_entries.set(len(loaded_entries), data=data_name)
+
+    async def _seed_last_seen(self, data_key: str) -> None:
+        """Gives the entries stored before ``storage_ttl`` was set the
+        current time, so they expire too."""
+        now = time.time()
+        fields = []
+        async for field, _ in self.redis.hscan_iter(self._get_key(data_key),
+                                                    count=SWEEP_BATCH_SIZE):
+            fields.append(field)
+            if len(fields) >= SWEEP_BATCH_SIZE:
+                await self.redis.zadd(self._get_last_seen_key(data_key),
+                                      dict.fromkeys(fields, now), nx=True)
+                fields = []
+        if fields:
+            await self.redis.zadd(self._get_last_seen_key(data_key),
+                                  dict.fromkeys(fields, now), nx=True)
+
+    def _strip_entry(self, value: Any) -> Any:
+        if not isinstance(value, dict):
+            return None
+        return {key: item for key, item in value.items()
+                if key in self.persistent_keys}
+
+    async def _expire_entries(self, data_name: str, data_key: str) -> None:
+        key = self._get_key(data_key)
+        last_seen_key = self._get_last_seen_key(data_key)
+        expired_before = time.time() - self.storage_ttl
+        while True:
+            with track('redis_command', command='zrangebyscore'):
+                fields = await self.redis.zrangebyscore(
+                    last_seen_key, '-inf', expired_before,
+                    start=0, num=SWEEP_BATCH_SIZE
+                )
+            fields = [field.decode() for field in fields
+                      if int(field) not in self._loaded_entries[data_name]
+                      and field.decode() not in self._changes[data_key]]
+            if not fields:
+                return
+            with track('redis_command', command='hmget'):
+                values = await self.redis.hmget(key, fields)
+
+            stripped_count = 0
+            async with self.redis.pipeline(transaction=True) as pipeline:
+                for field, data_bytes in zip(fields, values):
+                    if data_bytes is None:
+                        continue
+                    value = self._loads(data_bytes)
+                    stripped = self._strip_entry(value)
+                    if stripped == value:
+                        continue
+                    if stripped:
+                        pipeline.hset(key, field, self._dumps(stripped))
+                    else:
+                        pipeline.hdel(key, field)
+                    stripped_count += 1
+                pipeline.zrem(last_seen_key, *fields)
+                with track('redis_command', command='pipeline'):
+                    await pipeline.execute()
+            self.evicted_entries.inc(stripped_count, data=data_name,
+                                     reason='expired')
+            self.counters[f'{data_name}_expired'] += stripped_count
+            if len(fields) < SWEEP_BATCH_SIZE:
+                return
+
+    async def _apply_initial_data(self, name: str, data_key: str,
+                                  data: Dict) -> None:
+        initial_data = self._initial_data.pop(name, None)
+        if not isinstance(initial_data, dict):
+            return
+        data.update(initial_data)
+        mapping = {str(field): self._dumps(value)
+                   for field, value in initial_data.items()}
+        self._digests[data_key].update({
+            field: self._get_digest(value) for field, value in mapping.items()
+        })
+        await self._redis_pool_hset(self._get_key(data_key), mapping)
+
+    def _reset_changes(self) -> None:
+        self._changes = {data_key: {} for data_key in self._get_hash_keys()}
+        self._callback_data_change = None
+        self._last_seen = {data_key: {} for _, data_key
+                           in self._get_entry_keys()}
+
+    def _count_changes(self) -> int:
+        return (sum(map(len, self._changes.values()))
+                + (self._callback_data_change is not None))
+
+    def _stage_entry(self, data_key: str, field: Any, value: Any) -> None:
+        field, data_bytes = str(field), self._dumps(value)
+        digest = self._get_digest(data_bytes)
+        if self._digests[data_key].get(field) == digest:
+            return
+        self._digests[data_key][field] = digest
+        self._changes[data_key][field] = data_bytes
+
+    def _stage_drop(self, data_key: str, field: Any) -> None:
+        field = str(field)
+        self._digests[data_key].pop(field, None)
+        self._changes[data_key][field] = None
+
+    def _restore_changes(self, changes: Dict[str, Dict[str, Optional[bytes]]],
+                         callback_data_change: Optional[bytes],
+                         last_seen: Dict[str, Dict[str, float]]) -> None:
+        for data_key, entries in changes.items():
+            for field, data_bytes in entries.items():
+                self._changes[data_key].setdefault(field, data_bytes)
+        if self._callback_data_change is None:
+            self._callback_data_change = callback_data_change
+        for data_key, entries in last_seen.items():
+            for field, seen_at in entries.items():
+                self._last_seen[data_key].setdefault(field, seen_at)
+
+    async def _flush_changes(self) -> None:
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        async with self._flush_lock:
+            if not (self._count_changes()
+                    or any(self._last_seen.values())):
+                return
+            changes = self._changes
+            callback_data_change = self._callback_data_change
+            last_seen = self._last_seen
+            self._reset_changes()
+
+            async with self.redis.pipeline(transaction=True) as pipeline:
+                for data_key, entries in changes.items():
+                    key = self._get_key(data_key)
+                    if mapping := {field: data_bytes
+                                   for field, data_bytes in entries.items()
+                                   if data_bytes is not None}:
+                        pipeline.hset(key, mapping=mapping)
+                    if fields := [field
+                                  for field, data_bytes in entries.items()
+                                  if data_bytes is None]:
+                        pipeline.hdel(key, *fields)
+                if callback_data_change is not None:
+                    pipeline.set(self._get_key(self.callback_data_key),
+                                 callback_data_change)
+                for data_key, entries in last_seen.items():
+                    if entries:
+                        pipeline.zadd(self._get_last_seen_key(data_key),
+                                      entries)
+                try:
+                    with track('redis_command', command='pipeline'):
+                        await pipeline.execute()
+                except BaseException:
+                    self._restore_changes(changes, callback_data_change,
+                                          last_seen)
+                    raise
+
+    async def _flush_periodically(self) -> None:
+        while not self._flusher_stopped:
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._flush_requested.wait(),
+                                       self.flush_interval)
+            self._flush_requested.clear()
+            try:
+                await self._flush_changes()
+            except Exception as err:
+                logger.error(f'Не удалось сохранить данные в Redis: {err}')
+
+    async def _on_change(self) -> None:
+        if self.on_flush:
+            return
+        if not self.flush_interval:
+            await self._flush_changes()
+            return
+        if not self._flusher or self._flusher.done():
+            self._flush_requested = asyncio.Event()
+            self._flusher = asyncio.create_task(self._flush_periodically())
+        if self._count_changes() >= self.flush_max_changes:
+            self._flush_requested.set()
+
+    async def _get_bot_data_versions(self) -> Dict[str, int]:
+        data = await self._redis_pool_hgetall(
+            self._get_bot_data_versions_key()
+        )
+        return {field: int(version) for field, version in data.items()}
+
+    async def _receive_bot_data_updates(self) -> None:
+        versions = await self._get_bot_data_versions()
+        if not (fields := [field for field, version in versions.items()
+                           if version > self.bot_data_version]):
+            return
+        with track('redis_command', command='hmget'):
+            values = await self.redis.hmget(self._get_key(self.bot_data_key),
+                                            fields)
+        self._bot_data_updates.update({
+            field: data_bytes for field, data_bytes in zip(fields, values)
+            if data_bytes is not None
+        })
+        self.bot_data_version = max(versions.values())
+        logger.info(f'Получена версия {self.bot_data_version} bot_data: '
+                    f'{", ".join(fields)}')
+
+    async def _listen_bot_data_updates(self) -> None:
+        while not self._listener_stopped:
+            try:
+                async with self.redis.pubsub() as pubsub:
+                    await pubsub.subscribe(self._get_bot_data_channel())
+                    await self._receive_bot_data_updates()
+                    while not self._listener_stopped:
+                        if await pubsub.get_message(
+                                ignore_subscribe_messages=True, timeout=1):
+                            await self._receive_bot_data_updates()
+            except Exception as err:
+                logger.error(f'Подписка на обновления bot_data прервана: '
+                             f'{err}')
+                await asyncio.sleep(RESUBSCRIBE_DELAY)
+
+    def _is_stale(self, field: str, value: Any) -> bool:
+        """Tells whether ``value`` was replaced by an update from Redis,
+        e.g. in a copy of ``bot_data`` taken before the swap."""
+        if field not in self._stale_digests:
+            return False
+        digest = (None if value is MISSING
+                  else self._get_digest(self._dumps(value)))
+        if digest == self._stale_digests[field]:
+            return True
+        del self._stale_digests[field]
+        return False
 
     async def get_bot_data(self) -> BD:
         """Returns the bot_data from the Redis if it exists or
         an empty :obj:`dict`."""
-        if not self.bot_data:
-            await self._load_redis()
-        return deepcopy(self.bot_data)
+        if self.listen_bot_data_updates:
+            versions = await self._get_bot_data_versions()
+            self.bot_data_version = max(versions.values(), default=0)
+        bot_data = await self._load_hash(self.bot_data_key)
+        await self._apply_initial_data('bot_data', self.bot_data_key,
+                                       bot_data)
+        if self.listen_bot_data_updates and not self._listener:
+            self._listener = asyncio.create_task(
+                self._listen_bot_data_updates()
+            )
+        return bot_data
 
     async def update_bot_data(self, data: BD) -> None:
-        """Will update the bot_data and depending on :attr:`on_flush` save
-        in Redis."""
-        if self.bot_data == data:
-            return
-        self.bot_data = data
-        if not self.on_flush:
-            await self._dump_redis()
+        """Will update the changed bot_data keys and depending on
+        :attr:`on_flush` save in Redis."""
+        for field, value in data.items():
+            if not self._is_stale(field, value):
+                self._stage_entry(self.bot_data_key, field, value)
+        for field in set(self._digests[self.bot_data_key]) - set(data):
+            if not self._is_stale(field, MISSING):
+                self._stage_drop(self.bot_data_key, field)
+        await self._on_change()
 
     async def refresh_bot_data(self, bot_data: BD) -> None:
-        pass
+        """Swaps in the ``bot_data`` fields published by other processes.
+        """
+        if not self._bot_data_updates:
+            return
+        updates, self._bot_data_updates = self._bot_data_updates, {}
+        values = {field: self._loads(data_bytes)
+                  for field, data_bytes in updates.items()}
+        digests = self._digests[self.bot_data_key]
+        for field, data_bytes in updates.items():
+            self._stale_digests[field] = digests.get(field)
+            digests[field] = self._get_digest(data_bytes)
+            self._changes[self.bot_data_key].pop(field, None)
+        bot_data.update(values)
 
     async def get_chat_data(self) -> Dict[int, CD]:
-        """Returns the chat_data from the Redis if it exists or
-        an empty :obj:`dict`."""
-        if not self.chat_data:
-            await self._load_redis()
-        return deepcopy(self.chat_data)
+        """Returns the chat_data from ``initial_data`` or an empty
+        :obj:`dict`. The rest is loaded by :meth:`refresh_chat_data`."""
+        await self._check_legacy_data()
+        chat_data = defaultdict(dict)
+        await self._apply_initial_data('chat_data', self.chat_data_key,
+                                       chat_data)
+        return chat_data
 
     async def update_chat_data(self, chat_id: int, data: CD) -> None:
         """Will update the chat_data and depending on :attr:`on_flush` save
         in Redis."""
-        if self.chat_data is None:
-            self.chat_data = {}
-        if self.chat_data.get(chat_id) == data:
-            return
-        self.chat_data[chat_id] = data
-        if not self.on_flush:
-            await self._dump_redis()
+        self._stage_entry(self.chat_data_key, chat_id, data)
+        await self._on_change()
 
     async def refresh_chat_data(self, chat_id: int, chat_data: CD) -> None:
-        pass
+        """Loads the chat's data from the Redis on its first update."""
+        await self._refresh_entry('chat_data', self.chat_data_key, chat_id,
+                                  chat_data)
 
     async def drop_chat_data(self, chat_id: int) -> None:
         """Will delete the specified key from the ``chat_data`` and depending
         on :attr:`on_flush` save in Redis."""
-        if self.chat_data is None:
-            return
-        self.chat_data.pop(chat_id, None)
-
-        if not self.on_flush:
-            await self._dump_redis()
+        self._stage_drop(self.chat_data_key, chat_id)
+        await self._on_change()
 
     async def get_user_data(self) -> Dict[int, UD]:
-        """Returns the user_data from the Redis if it exists or an empty
-        :obj:`dict`."""
-        if not self.user_data:
-            await self._load_redis()
-        return deepcopy(self.user_data)
+        """Returns the user_data from ``initial_data`` or an empty
+        :obj:`dict`. The rest is loaded by :meth:`refresh_user_data`."""
+        await self._check_legacy_data()
+        user_data = defaultdict(dict)
+        await self._apply_initial_data('user_data', self.user_data_key,
+                                       user_data)
+        return user_data
 
     async def update_user_data(self, user_id: int, data: UD) -> None:
         """Will update the user_data and depending on :attr:`on_flush` save
         in Redis."""
-        if self.user_data is None:
-            self.user_data = {}
-        if self.user_data.get(user_id) == data:
-            return
-        self.user_data[user_id] = data
-        if not self.on_flush:
-            await self._dump_redis()
+        self._stage_entry(self.user_data_key, user_id, data)
+        await self._on_change()
 
     async def refresh_user_data(self, user_id: int, user_data: UD) -> None:
-        pass
+        """Loads the user's data from the Redis on their first update."""
+        await self._refresh_entry('user_data', self.user_data_key, user_id,
+                                  user_data)
 
     async def drop_user_data(self, user_id: int) -> None:
         """Will delete the specified key from the ``user_data`` and depending
         on :attr:`on_flush` save in Redis"""
-        if self.user_data is None:
-            return
-        self.user_data.pop(user_id, None)
-
-        if not self.on_flush:
-            await self._dump_redis()
+        self._stage_drop(self.user_data_key, user_id)
+        await self._on_change()
 
     async def get_callback_data(self) -> Optional[CDCData]:
-        """Returns the callback_data from the Redis if it exists or an empty
-        :obj:`dict`."""
-        if not self.callback_data:
-            await self._load_redis()
-        if self.callback_data is None:
+        """Returns the callback_data from the Redis if it exists or
+        :obj:`None`."""
+        data_bytes = await self._redis_pool_get(
+            self._get_key(self.callback_data_key)
+        )
+        if data_bytes is None:
             return None
-        return deepcopy(self.callback_data)
+        self._callback_data_digest = self._get_digest(data_bytes)
+        return self._loads(data_bytes)
 
     async def update_callback_data(self, data: CDCData) -> None:
         """Will update the callback_data and depending on :attr:`on_flush` save
         in Redis."""
-        if self.callback_data == data:
+        data_bytes = self._dumps(data)
+        digest = self._get_digest(data_bytes)
+        if self._callback_data_digest == digest:
             return
-        self.callback_data = data
-        if not self.on_flush:
-            await self._dump_redis()
+        self._callback_data_digest = digest
+        self._callback_data_change = data_bytes
+        await self._on_change()
 
     async def get_conversations(self, name: str) -> ConversationDict:
         """Returns the conversations from the Redis if it exists or an empty
         :obj:`dict`."""
-        if not self.conversations:
-            await self._load_redis()
+        if self.conversations is None:
+            self.conversations = await self._load_hash(self.conversations_key)
         return self.conversations.get(name, {}).copy()
 
     async def update_conversation(
@@ -248,21 +736,65 @@ class RedisPersistence(BasePersistence[UD, CD, BD]):
     ) -> None:
         """Will update the conversations for the given handler and depending
         on :attr:`on_flush` save in Redis."""
-        if not self.conversations:
+        if self.conversations is None:
             self.conversations = {}
         if self.conversations.setdefault(name, {}).get(key) == new_state:
             return
         self.conversations[name][key] = new_state
-        if not self.on_flush:
-            await self._dump_redis()
+        self._stage_entry(self.conversations_key, name,
+                          self.conversations[name])
+        await self._on_change()
+
+    async def sweep(self) -> None:
+        """Frees idle users and chats from memory and, if ``storage_ttl``
+        is set, strips the expired ones in Redis."""
+        for data_name, data_key in self._get_entry_keys():
+            self._evict_entries(data_name, data_key)
+        if not self.storage_ttl:
+            return
+        await self._check_legacy_data()
+        if not self._last_seen_seeded:
+            for _, data_key in self._get_entry_keys():
+                await self._seed_last_seen(data_key)
+            self._last_seen_seeded = True
+        await self._flush_changes()
+        for data_name, data_key in self._get_entry_keys():
+            await self._expire_entries(data_name, data_key)
+
+    async def sweep_job(self, context: CallbackContext.DEFAULT_TYPE) -> None:
+        try:
+            await self.sweep()
+        except Exception as err:
+            logger.error(f'Не удалось очистить устаревшие данные: {err}')
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'loaded_users': len(self._loaded_entries['user_data']),
+            'loaded_chats': len(self._loaded_entries['chat_data']),
+            'evicted_users': self.counters['user_data_evicted'],
+            'evicted_chats': self.counters['chat_data_evicted'],
+            'expired_users': self.counters['user_data_expired'],
+            'expired_chats': self.counters['chat_data_expired'],
+        }
 
     async def flush(self) -> None:
-        """Will save all data in memory in Redis."""
-        if (
-                self.user_data
-                or self.chat_data
-                or self.bot_data
-                or self.callback_data
-                or self.conversations
-        ):
-            await self._dump_redis()
+        """Will stop the periodic flushes and the bot_data subscription and
+        save all pending changes in Redis."""
+        if self._listener:
+            self._listener_stopped = True
+            self._listener.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._listener
+            self._listener, self._listener_stopped = None, False
+        if self._flusher:
+            self._flusher_stopped = True
+            self._flush_requested.set()
+            await self._flusher
+            self._flusher, self._flusher_stopped = None, False
+        await self._flush_changes()
+
+    async def close(self) -> None:
+        """Will close the connection pool if it was created by the
+        persistence."""
+        if self._owns_redis:
+            await close_redis(self.redis)
@@ -0,0 +1,140 @@
+import logging
+import random
+import time
+from typing import Any, Optional, Tuple
+
+from metrics import REGISTRY, MetricsRegistry
+
+logger = logging.getLogger(__file__)
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class RetryPolicy:
+    """Retry settings for idempotent upstream calls.
+
+    Delays use exponential backoff with full jitter. A ``Retry-After``
+    header sent by the upstream takes precedence over the computed delay.
+    """
+
+    def __init__(self, max_attempts: int = 3, backoff_base: float = 0.2,
+                 backoff_max: float = 5, deadline: float = 10,
+                 retry_statuses: Tuple[int, ...] = (429, 500, 502, 503, 504)):
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.deadline = deadline
+        self.retry_statuses = retry_statuses
+
+    def get_delay(self, attempt: int,
+                  retry_after: Optional[float] = None) -> float:
+        if retry_after is not None:
+            return retry_after
+        return random.uniform(
+            0, min(self.backoff_max, self.backoff_base * 2 ** attempt)
+        )
+
+    @staticmethod
+    def parse_retry_after(headers: Any) -> Optional[float]:
+        if not headers or not (retry_after := headers.get('Retry-After')):
+            return None
+        try:
+            return max(float(retry_after), 0)
+        except ValueError:
+            return None
+
+
+class CircuitBreaker:
+    """Fails fast while an upstream keeps failing.
+
+    After ``failure_threshold`` consecutive failures the breaker opens and
+    rejects calls for ``recovery_timeout`` seconds. Then a single trial call
+    is let through: its success closes the breaker, its failure opens it
+    again. The state, failures and rejected calls are exported to the
+    metrics registry with the ``breaker`` label.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+    STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(self, name: str, failure_threshold: int = 5,
+                 recovery_timeout: float = 30,
+                 registry: MetricsRegistry = REGISTRY):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.consecutive_failures = 0
+        self.opened_at: Optional[float] = None
+        self._state = self.CLOSED
+        self._trial_started_at: Optional[float] = None
+        self.state_gauge = registry.gauge(
+            'circuit_breaker_state',
+            'Circuit breaker state: 0 closed, 1 half-open, 2 open.',
+            ('breaker',)
+        )
+        self.consecutive_failures_gauge = registry.gauge(
+            'circuit_breaker_consecutive_failures',
+            'Failures in a row seen by the circuit breaker.', ('breaker',)
+        )
+        self.failures = registry.counter(
+            'circuit_breaker_failures_total',
+            'Failures seen by the circuit breaker.', ('breaker',)
+        )
+        self.rejected_calls = registry.counter(
+            'circuit_breaker_rejected_calls_total',
+            'Calls rejected while the circuit breaker was open.',
+            ('breaker',)
+        )
+        self.state_gauge.set(self.STATE_VALUES[self._state], breaker=name)
+        self.consecutive_failures_gauge.set(0, breaker=name)
+        self.failures.inc(0, breaker=name)
+        self.rejected_calls.inc(0, breaker=name)
+
+    def _timed_out(self, started_at: Optional[float]) -> bool:
+        return (started_at is None
+                or time.monotonic() - started_at >= self.recovery_timeout)
+
+    @property
+    def state(self) -> str:
+        if self._state == self.OPEN and self._timed_out(self.opened_at):
+            self._set_state(self.HALF_OPEN)
+        return self._state
+
+    def _set_state(self, state: str) -> None:
+        if state == self._state:
+            return
+        logger.warning(f'Состояние circuit breaker {self.name}: {state}')
+        self._state = state
+        self._trial_started_at = None
+        self.state_gauge.set(self.STATE_VALUES[state], breaker=self.name)
+        if state == self.OPEN:
+            self.opened_at = time.monotonic()
+
+    def before_call(self) -> None:
+        state = self.state
+        if state == self.OPEN or (
+                state == self.HALF_OPEN
+                and not self._timed_out(self._trial_started_at)
+        ):
+            self.rejected_calls.inc(breaker=self.name)
+            raise CircuitOpenError(f'{self.name} is unavailable')
+        if state == self.HALF_OPEN:
+            self._trial_started_at = time.monotonic()
+
+    def record_success(self) -> None:
+        self.consecutive_failures = 0
+        self.consecutive_failures_gauge.set(0, breaker=self.name)
+        self._set_state(self.CLOSED)
+
+    def record_failure(self) -> None:
+        self.consecutive_failures += 1
+        self.consecutive_failures_gauge.set(self.consecutive_failures,
+                                            breaker=self.name)
+        self.failures.inc(breaker=self.name)
+        if (self._state == self.HALF_OPEN
+                or self.consecutive_failures >= self.failure_threshold):
+            self._set_state(self.OPEN)
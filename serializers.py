@@ -0,0 +1,185 @@
+import logging
+import pickle
+import time
+from collections import defaultdict
+from typing import Any, Dict
+
+import telegram
+from telegram import TelegramObject
+
+from metrics import REGISTRY, MetricsRegistry, track
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__file__)
+
+MAGIC = b'PZ'
+SCHEMA_VERSION = 1
+HEADER_SIZE = len(MAGIC) + 3
+
+CODEC_IDS = {'pickle': 0, 'msgpack': 1}
+CODEC_NAMES = {codec_id: codec for codec, codec_id in CODEC_IDS.items()}
+ZSTD_FLAG = 1
+
+TUPLE_EXT = 1
+SET_EXT = 2
+TELEGRAM_OBJECT_EXT = 3
+PICKLE_EXT = 4
+
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+
+class Serializer:
+    """Encodes persisted bot state with a versioned header.
+
+    Every value starts with ``MAGIC``, the schema version, the codec id and
+    flags. ``msgpack`` is used when it is installed: Telegram objects such
+    as ``InlineKeyboardMarkup`` are stored as their Bot API dicts, tuples
+    and sets keep their types, anything else falls back to pickle. Values
+    longer than ``compression_threshold`` bytes are compressed with zstd
+    when ``zstandard`` is installed. Values without the header are decoded
+    as pickle, so data written by earlier versions can still be read.
+    """
+
+    def __init__(self, codec: str = 'msgpack',
+                 compression_threshold: int = 1024,
+                 compression_level: int = 3,
+                 registry: MetricsRegistry = REGISTRY):
+        if codec not in CODEC_IDS:
+            raise ValueError(f'Unknown codec {codec}')
+        if codec == 'msgpack' and not msgpack:
+            logger.warning('msgpack не установлен, данные сохраняются '
+                           'через pickle')
+            codec = 'pickle'
+        if compression_threshold and not zstandard:
+            logger.warning('zstandard не установлен, данные сохраняются '
+                           'без сжатия')
+            compression_threshold = 0
+        self.codec = codec
+        self.compression_threshold = compression_threshold
+        self._compressor = (zstandard.ZstdCompressor(level=compression_level)
+                            if compression_threshold else None)
+        self._decompressor = (zstandard.ZstdDecompressor() if zstandard
+                              else None)
+        self.encoded_size = registry.histogram(
+            'serializer_encoded_bytes', 'Size of encoded values in bytes.',
+            ('codec',), buckets=SIZE_BUCKETS
+        )
+        self.registry = registry
+        self.counters: Dict[str, float] = defaultdict(float)
+
+    @staticmethod
+    def _encode_default(obj: Any) -> Any:
+        if isinstance(obj, tuple):
+            return msgpack.ExtType(TUPLE_EXT, Serializer._pack(list(obj)))
+        if isinstance(obj, (set, frozenset)):
+            return msgpack.ExtType(SET_EXT, Serializer._pack(list(obj)))
+        if isinstance(obj, TelegramObject):
+            return msgpack.ExtType(TELEGRAM_OBJECT_EXT, Serializer._pack(
+                [type(obj).__name__, obj.to_dict()]
+            ))
+        if type(obj) is defaultdict and obj.default_factory is dict:
+            return dict(obj)
+        return msgpack.ExtType(PICKLE_EXT, pickle.dumps(obj))
+
+    @staticmethod
+    def _decode_ext(code: int, data: bytes) -> Any:
+        if code == PICKLE_EXT:
+            return pickle.loads(data)
+        value = Serializer._unpack(data)
+        if code == TUPLE_EXT:
+            return tuple(value)
+        if code == SET_EXT:
+            return set(value)
+        if code == TELEGRAM_OBJECT_EXT:
+            class_name, object_data = value
+            return getattr(telegram, class_name).de_json(object_data, None)
+        return msgpack.ExtType(code, data)
+
+    @staticmethod
+    def _pack(obj: Any) -> bytes:
+        return msgpack.packb(obj, default=Serializer._encode_default,
+                             strict_types=True, use_bin_type=True)
+
+    @staticmethod
+    def _unpack(data: bytes) -> Any:
+        return msgpack.unpackb(data, ext_hook=Serializer._decode_ext,
+                               strict_map_key=False, raw=False)
+
+    def is_current(self, data: bytes) -> bool:
+        return (data[:len(MAGIC)] == MAGIC
+                and data[len(MAGIC)] == SCHEMA_VERSION
+                and data[len(MAGIC) + 1] == CODEC_IDS[self.codec])
+
+    def dumps(self, obj: Any) -> bytes:
+        started_at = time.perf_counter()
+        with track('serializer_encode', self.registry, codec=self.codec):
+            if self.codec == 'msgpack':
+                payload = self._pack(obj)
+            else:
+                payload = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+            flags = 0
+            if self._compressor and len(payload) > self.compression_threshold:
+                payload = self._compressor.compress(payload)
+                flags |= ZSTD_FLAG
+        data = (MAGIC + bytes((SCHEMA_VERSION, CODEC_IDS[self.codec], flags))
+                + payload)
+        self.encoded_size.observe(len(data), codec=self.codec)
+        self.counters['encoded'] += 1
+        self.counters['encoded_bytes'] += len(data)
+        self.counters['encode_seconds'] += time.perf_counter() - started_at
+        return data
+
+    def loads(self, data: bytes) -> Any:
+        started_at = time.perf_counter()
+        if data[:len(MAGIC)] != MAGIC:
+            codec = 'pickle'
+            with track('serializer_decode', self.registry, codec=codec):
+                obj = pickle.loads(data)
+        else:
+            version, codec_id, flags = data[len(MAGIC):HEADER_SIZE]
+            if version > SCHEMA_VERSION:
+                raise ValueError(f'Unsupported schema version {version}')
+            codec = CODEC_NAMES[codec_id]
+            with track('serializer_decode', self.registry, codec=codec):
+                payload = data[HEADER_SIZE:]
+                if flags & ZSTD_FLAG:
+                    if not self._decompressor:
+                        raise RuntimeError('zstandard is required to decode '
+                                           'compressed data')
+                    payload = self._decompressor.decompress(payload)
+                if codec == 'msgpack':
+                    if not msgpack:
+                        raise RuntimeError('msgpack is required to decode '
+                                           'msgpack data')
+                    obj = self._unpack(payload)
+                else:
+                    obj = pickle.loads(payload)
+        self.counters['decoded'] += 1
+        self.counters['decoded_bytes'] += len(data)
+        self.counters['decode_seconds'] += time.perf_counter() - started_at
+        return obj
+
+    def stats(self) -> Dict[str, Any]:
+        counters = {
+            name: self.counters[name]
+            for name in ('encoded', 'encoded_bytes', 'encode_seconds',
+                         'decoded', 'decoded_bytes', 'decode_seconds')
+        }
+        return {
+            'codec': self.codec,
+            'compression_threshold': self.compression_threshold,
+            **counters,
+            'average_encoded_bytes': (
+                counters['encoded_bytes'] / counters['encoded']
+                if counters['encoded'] else 0
+            ),
+        }
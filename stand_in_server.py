@@ -0,0 +1,534 @@
+import asyncio
+import json
+import logging
+import random
+import re
+import time
+import uuid
+import zlib
+from collections import Counter
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from aiohttp import web
+from environs import Env
+from slugify import slugify
+
+from coordinate_utils import normalize_address
+
+logger = logging.getLogger(__file__)
+
+FIXTURES_DIR = Path(__file__).parent / 'fixtures' / 'stand_in'
+FILTER_PATTERN = re.compile(r'^(eq|in)\((\w+),\s*(.*)\)$')
+
+# Addresses missing from the geocode fixture are placed inside this box,
+# so the nearest pizzeria search gets realistic input.
+MOSCOW_BBOX = (37.35, 55.57, 37.85, 55.91)
+
+
+def load_fixture(fixtures_dir: Path, name: str, default: Any) -> Any:
+    fixture_path = fixtures_dir / f'{name}.json'
+    if not fixture_path.exists():
+        return default
+    with open(fixture_path, encoding='utf-8') as fixture:
+        return json.load(fixture)
+
+
+def format_price(amount: int, currency: str = 'RUB') -> Dict[str, Any]:
+    return {
+        'amount': amount,
+        'currency': currency,
+        'formatted': f'{amount // 100}',
+    }
+
+
+def parse_filter(filter_expression: Optional[str]) -> Tuple[str, str, list]:
+    if not filter_expression:
+        return '', '', []
+    if not (match := FILTER_PATTERN.match(filter_expression.strip())):
+        raise web.HTTPBadRequest(text=f'Bad filter {filter_expression}')
+    operator, field, values = match.groups()
+    return operator, field, [value.strip() for value in values.split(',')]
+
+
+class StandInState:
+    """Mutable Moltin and Yandex data served by the stand-in.
+
+    Catalog resources are loaded from fixture files, carts, customers,
+    tokens and flow entries created by clients live in memory only.
+    """
+
+    def __init__(self, fixtures_dir: Path = FIXTURES_DIR):
+        self.products: Dict[str, Dict[str, Any]] = {}
+        for product in load_fixture(fixtures_dir, 'products', []):
+            self.add_product(product)
+        self.files = {
+            file['id']: file
+            for file in load_fixture(fixtures_dir, 'files', [])
+        }
+        self.categories = {
+            category['id']: category
+            for category in load_fixture(fixtures_dir, 'categories', [])
+        }
+        self.promotions = load_fixture(fixtures_dir, 'promotions', [])
+        self.flows: Dict[str, List[Dict[str, Any]]] = load_fixture(
+            fixtures_dir, 'flows', {}
+        )
+        geocode = load_fixture(fixtures_dir, 'geocode', {})
+        self.addresses = {
+            normalize_address(address): coordinates
+            for address, coordinates in geocode.get('addresses', {}).items()
+        }
+        self.not_found_addresses = {
+            normalize_address(address)
+            for address in geocode.get('not_found', [])
+        }
+        self.tokens: Dict[str, float] = {}
+        self.carts: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        self.customers: Dict[str, Dict[str, Any]] = {}
+
+    def add_product(self, product: Dict[str, Any]) -> Dict[str, Any]:
+        price = product['price'][0]
+        product.setdefault('meta', {})['display_price'] = {
+            'with_tax': format_price(price['amount'], price['currency']),
+        }
+        product.setdefault('relationships', {})
+        self.products[product['id']] = product
+        return product
+
+    def get_cart_items(self, cart_id: str) -> Dict[str, Any]:
+        cart_items = []
+        total_amount = 0
+        for cart_item in self.carts.get(cart_id, {}).values():
+            product = self.products.get(cart_item['product_id'])
+            if not product:
+                continue
+            unit_amount = product['price'][0]['amount']
+            value_amount = unit_amount * cart_item['quantity']
+            total_amount += value_amount
+            cart_items.append({
+                'type': 'cart_item',
+                'id': cart_item['id'],
+                'product_id': product['id'],
+                'name': product['name'],
+                'description': product['description'],
+                'sku': product['sku'],
+                'quantity': cart_item['quantity'],
+                'meta': {
+                    'display_price': {
+                        'with_tax': {
+                            'unit': format_price(unit_amount),
+                            'value': format_price(value_amount),
+                        },
+                    },
+                },
+            })
+        return {
+            'data': cart_items,
+            'meta': {
+                'display_price': {
+                    'with_tax': format_price(total_amount),
+                },
+            },
+        }
+
+    def geocode(self, address: str) -> Optional[Tuple[str, str]]:
+        address_key = normalize_address(address)
+        if not address_key or address_key in self.not_found_addresses:
+            return None
+        if coordinates := self.addresses.get(address_key):
+            return tuple(coordinates)
+        address_hash = zlib.crc32(address_key.encode())
+        min_lon, min_lat, max_lon, max_lat = MOSCOW_BBOX
+        lon = min_lon + (address_hash & 0xffff) / 0xffff * (max_lon - min_lon)
+        lat = min_lat + (address_hash >> 16) / 0xffff * (max_lat - min_lat)
+        return f'{lon:.6f}', f'{lat:.6f}'
+
+
+def get_state(request: web.Request) -> StandInState:
+    return request.app['state']
+
+
+def check_token(request: web.Request) -> None:
+    authorization = request.headers.get('Authorization', '')
+    access_token = authorization.replace('Bearer', '').strip()
+    expires_at = get_state(request).tokens.get(access_token)
+    if expires_at is None or expires_at < time.time():
+        raise web.HTTPUnauthorized(
+            text=json.dumps({'errors': [{'title': 'Unauthorized'}]}),
+            content_type='application/json'
+        )
+
+
+def paginate(request: web.Request,
+             items: List[Dict[str, Any]]) -> Dict[str, Any]:
+    limit = int(request.query.get('page[limit]', 100))
+    offset = int(request.query.get('page[offset]', 0))
+    total_pages = max((len(items) + limit - 1) // limit, 1)
+    next_page_url = None
+    if offset + limit < len(items):
+        next_page = request.rel_url.update_query({
+            'page[limit]': limit,
+            'page[offset]': offset + limit,
+        })
+        next_page_url = f'{request.scheme}://{request.host}{next_page}'
+    return {
+        'data': items[offset:offset + limit],
+        'links': {'next': next_page_url},
+        'meta': {
+            'page': {
+                'limit': limit,
+                'offset': offset,
+                'current': offset // limit + 1,
+                'total': total_pages,
+            },
+            'results': {'total': len(items)},
+        },
+    }
+
+
+@web.middleware
+async def fault_injection_middleware(request: web.Request,
+                                     handler) -> web.StreamResponse:
+    config = request.app['config']
+    resource = request.match_info.route.resource
+    endpoint = resource.canonical if resource else request.path
+    request.app['request_counts'][f'{request.method} {endpoint}'] += 1
+
+    latency_min, latency_max = config['latency']
+    if latency_max:
+        await asyncio.sleep(random.uniform(latency_min, latency_max))
+
+    chance = random.random()
+    if chance < config['rate_limit_rate']:
+        return web.json_response(
+            {'errors': [{'status': 429, 'title': 'Too Many Requests'}]},
+            status=429,
+            headers={'Retry-After': str(config['retry_after'])}
+        )
+    if chance < config['rate_limit_rate'] + config['error_rate']:
+        return web.json_response(
+            {'errors': [{'status': 500, 'title': 'Internal Server Error'}]},
+            status=500
+        )
+    return await handler(request)
+
+
+routes = web.RouteTableDef()
+
+
+@routes.post('/oauth/access_token')
+async def create_access_token(request: web.Request) -> web.Response:
+    access_token = uuid.uuid4().hex
+    expires_in = request.app['config']['token_ttl']
+    expires_at = int(time.time()) + expires_in
+    get_state(request).tokens[access_token] = expires_at
+    return web.json_response({
+        'access_token': access_token,
+        'expires': expires_at,
+        'expires_in': expires_in,
+        'identifier': 'client_credentials',
+        'token_type': 'Bearer',
+    })
+
+
+@routes.get('/v2/products')
+async def get_products(request: web.Request) -> web.Response:
+    check_token(request)
+    state = get_state(request)
+    operator, field, values = parse_filter(request.query.get('filter'))
+    products = [
+        product for product in state.products.values()
+        if not operator or str(product.get(field)) in values
+    ]
+    response = {'data': products}
+    if request.query.get('include') == 'main_image':
+        images_ids = {
+            product['relationships']['main_image']['data']['id']
+            for product in products
+            if product['relationships'].get('main_image')
+        }
+        response['included'] = {
+            'main_images': [state.files[image_id] for image_id in images_ids
+                            if image_id in state.files],
+        }
+    return web.json_response(response)
+
+
+@routes.post('/v2/products')
+async def create_product(request: web.Request) -> web.Response:
+    check_token(request)
+    product = (await request.json())['data']
+    product['id'] = str(uuid.uuid4())
+    product = get_state(request).add_product(product)
+    return web.json_response({'data': product}, status=201)
+
+
+@routes.get('/v2/products/{product_id}')
+async def get_product(request: web.Request) -> web.Response:
+    check_token(request)
+    product_id = request.match_info['product_id']
+    if not (product := get_state(request).products.get(product_id)):
+        raise web.HTTPNotFound()
+    return web.json_response({'data': product})
+
+
+@routes.delete('/v2/products/{product_id}')
+async def delete_product(request: web.Request) -> web.Response:
+    check_token(request)
+    product_id = request.match_info['product_id']
+    if not get_state(request).products.pop(product_id, None):
+        raise web.HTTPNotFound()
+    return web.Response(status=204)
+
+
+@routes.post('/v2/products/{product_id}/relationships/main-image')
+async def add_product_main_image(request: web.Request) -> web.Response:
+    check_token(request)
+    product_id = request.match_info['product_id']
+    if not (product := get_state(request).products.get(product_id)):
+        raise web.HTTPNotFound()
+    main_image = (await request.json())['data']
+    product['relationships']['main_image'] = {'data': main_image}
+    return web.json_response({'data': main_image})
+
+
+@routes.get('/v2/files/{file_id}')
+async def get_file(request: web.Request) -> web.Response:
+    check_token(request)
+    file_id = request.match_info['file_id']
+    if not (file := get_state(request).files.get(file_id)):
+        raise web.HTTPNotFound()
+    return web.json_response({'data': file})
+
+
+@routes.post('/v2/files')
+async def create_file(request: web.Request) -> web.Response:
+    check_token(request)
+    file_description = await request.json()
+    file_location = file_description.get('file_location')
+    if isinstance(file_location, list):
+        file_location = file_location[-1]
+    file = {
+        'type': 'file',
+        'id': str(uuid.uuid4()),
+        'link': {'href': file_location},
+    }
+    get_state(request).files[file['id']] = file
+    return web.json_response({'data': file}, status=201)
+
+
+@routes.get('/v2/carts/{cart_id}')
+async def get_cart(request: web.Request) -> web.Response:
+    check_token(request)
+    cart_id = request.match_info['cart_id']
+    state = get_state(request)
+    state.carts.setdefault(cart_id, {})
+    cart_items = state.get_cart_items(cart_id)
+    return web.json_response({
+        'data': {
+            'type': 'cart',
+            'id': cart_id,
+            'meta': cart_items['meta'],
+        },
+    })
+
+
+@routes.delete('/v2/carts/{cart_id}')
+async def delete_cart(request: web.Request) -> web.Response:
+    check_token(request)
+    get_state(request).carts.pop(request.match_info['cart_id'], None)
+    return web.Response(status=204)
+
+
+@routes.get('/v2/carts/{cart_id}/items')
+async def get_cart_items(request: web.Request) -> web.Response:
+    check_token(request)
+    cart_id = request.match_info['cart_id']
+    return web.json_response(get_state(request).get_cart_items(cart_id))
+
+
+@routes.post('/v2/carts/{cart_id}/items')
+async def add_cart_item(request: web.Request) -> web.Response:
+    check_token(request)
+    cart_id = request.match_info['cart_id']
+    state = get_state(request)
+    item = (await request.json())['data']
+    if item['id'] not in state.products:
+        raise web.HTTPNotFound()
+
+    cart = state.carts.setdefault(cart_id, {})
+    cart_item = cart.setdefault(item['id'], {
+        'id': str(uuid.uuid4()),
+        'product_id': item['id'],
+        'quantity': 0,
+    })
+    cart_item['quantity'] += int(item['quantity'])
+    return web.json_response(state.get_cart_items(cart_id), status=201)
+
+
+@routes.delete('/v2/carts/{cart_id}/items/{item_id}')
+async def remove_cart_item(request: web.Request) -> web.Response:
+    check_token(request)
+    cart_id = request.match_info['cart_id']
+    item_id = request.match_info['item_id']
+    state = get_state(request)
+    cart = state.carts.get(cart_id, {})
+    for product_id, cart_item in list(cart.items()):
+        if cart_item['id'] == item_id:
+            del cart[product_id]
+            break
+    else:
+        raise web.HTTPNotFound()
+    return web.json_response(state.get_cart_items(cart_id))
+
+
+@routes.get('/v2/customers')
+async def get_customers(request: web.Request) -> web.Response:
+    check_token(request)
+    operator, field, values = parse_filter(request.query.get('filter'))
+    customers = [
+        customer for customer in get_state(request).customers.values()
+        if not operator or str(customer.get(field)) in values
+    ]
+    return web.json_response({'data': customers})
+
+
+@routes.post('/v2/customers')
+async def create_customer(request: web.Request) -> web.Response:
+    check_token(request)
+    customer = (await request.json())['data']
+    state = get_state(request)
+    if any(existing['email'] == customer['email']
+           for existing in state.customers.values()):
+        return web.json_response(
+            {'errors': [{'status': 409, 'title': 'Duplicate email'}]},
+            status=409
+        )
+    customer['id'] = str(uuid.uuid4())
+    state.customers[customer['id']] = customer
+    return web.json_response({'data': customer}, status=201)
+
+
+@routes.post('/v2/flows')
+async def create_flow(request: web.Request) -> web.Response:
+    check_token(request)
+    flow = (await request.json())['data']
+    flow['id'] = str(uuid.uuid4())
+    flow.setdefault('slug', slugify(flow['name']))
+    get_state(request).flows.setdefault(flow['slug'], [])
+    return web.json_response({'data': flow}, status=201)
+
+
+@routes.post('/v2/fields')
+async def create_flow_field(request: web.Request) -> web.Response:
+    check_token(request)
+    field = (await request.json())['data']
+    field['id'] = str(uuid.uuid4())
+    return web.json_response({'data': field}, status=201)
+
+
+@routes.get('/v2/flows/{flow_slug}/entries')
+async def get_entries(request: web.Request) -> web.Response:
+    check_token(request)
+    flow_slug = request.match_info['flow_slug']
+    if (entries := get_state(request).flows.get(flow_slug)) is None:
+        raise web.HTTPNotFound()
+    return web.json_response(paginate(request, entries))
+
+
+@routes.post('/v2/flows/{flow_slug}/entries')
+async def create_flow_entry(request: web.Request) -> web.Response:
+    check_token(request)
+    flow_slug = request.match_info['flow_slug']
+    if (entries := get_state(request).flows.get(flow_slug)) is None:
+        raise web.HTTPNotFound()
+    entry = (await request.json())['data']
+    entry['id'] = str(uuid.uuid4())
+    entries.append(entry)
+    return web.json_response({'data': entry}, status=201)
+
+
+@routes.get('/v2/categories')
+async def get_categories(request: web.Request) -> web.Response:
+    check_token(request)
+    categories = list(get_state(request).categories.values())
+    return web.json_response({'data': categories})
+
+
+@routes.get('/v2/categories/{category_id}')
+async def get_category(request: web.Request) -> web.Response:
+    check_token(request)
+    category_id = request.match_info['category_id']
+    if not (category := get_state(request).categories.get(category_id)):
+        raise web.HTTPNotFound()
+    return web.json_response({'data': category})
+
+
+@routes.get('/v2/promotions')
+async def get_promotions(request: web.Request) -> web.Response:
+    check_token(request)
+    return web.json_response({'data': get_state(request).promotions})
+
+
+@routes.get('/1.x')
+async def geocode(request: web.Request) -> web.Response:
+    if not request.query.get('apikey'):
+        raise web.HTTPForbidden()
+    coordinates = get_state(request).geocode(request.query.get('geocode', ''))
+    found_places = []
+    if coordinates:
+        found_places.append({
+            'GeoObject': {
+                'name': request.query['geocode'],
+                'Point': {'pos': ' '.join(coordinates)},
+            },
+        })
+    return web.json_response({
+        'response': {
+            'GeoObjectCollection': {
+                'featureMember': found_places,
+            },
+        },
+    })
+
+
+def create_app(fixtures_dir: Path = FIXTURES_DIR,
+               latency: Tuple[float, float] = (0, 0),
+               error_rate: float = 0, rate_limit_rate: float = 0,
+               retry_after: int = 1,
+               token_ttl: int = 3600) -> web.Application:
+    app = web.Application(middlewares=[fault_injection_middleware])
+    app['state'] = StandInState(fixtures_dir)
+    app['request_counts'] = Counter()
+    app['config'] = {
+        'latency': latency,
+        'error_rate': error_rate,
+        'rate_limit_rate': rate_limit_rate,
+        'retry_after': retry_after,
+        'token_ttl': token_ttl,
+    }
+    app.add_routes(routes)
+    return app
+
+
+def main() -> None:
+    env = Env()
+    env.read_env()
+    logging.basicConfig(level=logging.INFO)
+
+    app = create_app(
+        fixtures_dir=env.path('STAND_IN_FIXTURES_DIR', FIXTURES_DIR),
+        latency=(env.float('STAND_IN_LATENCY_MIN', 0),
+                 env.float('STAND_IN_LATENCY_MAX', 0)),
+        error_rate=env.float('STAND_IN_ERROR_RATE', 0),
+        rate_limit_rate=env.float('STAND_IN_RATE_LIMIT_RATE', 0),
+        retry_after=env.int('STAND_IN_RETRY_AFTER', 1),
+        token_ttl=env.int('STAND_IN_TOKEN_TTL', 3600),
+    )
+    web.run_app(app, host=env.str('STAND_IN_HOST', '127.0.0.1'),
+                port=env.int('STAND_IN_PORT', 8080))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+import asyncio
+import json
+
+import pytest
+
+from background_tasks import BackgroundTaskQueue
+
+fakeredis_aioredis = pytest.importorskip('fakeredis.aioredis')
+
+
+def create_queue(redis, runs):
+    async def record(value):
+        runs.append(value)
+
+    queue = BackgroundTaskQueue(redis=redis, key_prefix='tg:tasks',
+                                workers=1)
+    queue.register('record', record)
+    return queue
+
+
+def dump_task(task_id, value):
+    return json.dumps({'id': task_id, 'name': 'record', 'args': [value],
+                       'kwargs': {}})
+
+
+def test_runs_and_forgets_submitted_tasks():
+    async def run():
+        redis = fakeredis_aioredis.FakeRedis()
+        runs = []
+        queue = create_queue(redis, runs)
+        await queue.start()
+        for value in range(3):
+            await queue.submit('record', value)
+        await queue.drain()
+
+        assert runs == [0, 1, 2]
+        assert await redis.keys('tg:tasks:*') == []
+
+    asyncio.run(run())
+
+
+def test_adopts_tasks_of_stopped_instances_only():
+    async def run():
+        redis = fakeredis_aioredis.FakeRedis()
+        await redis.sadd('tg:tasks:instances', 'stopped', 'alive')
+        await redis.set('tg:tasks:heartbeat:alive', 1, 60)
+        for value in ('first', 'second'):
+            await redis.lpush('tg:tasks:processing:stopped',
+                              dump_task(value, value))
+        await redis.lpush('tg:tasks:processing:alive',
+                          dump_task('busy', 'busy'))
+        runs = []
+        queue = create_queue(redis, runs)
+        await queue.start()
+        await queue.drain()
+
+        assert runs == ['first', 'second']
+        assert await redis.llen('tg:tasks:processing:stopped') == 0
+        assert await redis.llen('tg:tasks:processing:alive') == 1
+        assert await redis.smembers('tg:tasks:instances') == {b'alive'}
+
+    asyncio.run(run())
@@ -1,45 +1,61 @@
+import asyncio
 import logging
-from datetime import datetime
+import signal
+from contextlib import suppress
+from pathlib import Path
 from textwrap import dedent
-from typing import Union
+from typing import Any, Dict, Iterable, Optional, Tuple, Union
 
-import requests
+import aiohttp
+import aioredis
+from aiohttp import web
 from environs import Env
 from telegram import (
+    Bot,
     Update,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
     BotCommand
 )
 from telegram.constants import ParseMode
+from telegram.error import TelegramError
 from telegram.ext import (
     filters,
     Application,
     CallbackContext,
     CallbackQueryHandler,
+    CommandHandler,
     MessageHandler,
     PreCheckoutQueryHandler
 )
 from validate_email import validate_email
 
-from coordinate_utils import fetch_coordinates, get_nearest_restaurant
-from moltin_api import (
-    get_access_token,
-    get_product,
-    get_or_create_cart,
-    add_cart_item,
-    get_cart_items,
-    remove_cart_item,
-    delete_cart,
-    get_available_entries,
-    create_flow_entry,
-    get_customer_by_email,
-    get_or_create_customer_by_email, get_category, get_promotions
+from background_tasks import BackgroundTaskQueue
+from coordinate_utils import (
+    get_nearest_restaurant,
+    GeocodeCache,
+    RestaurantsIndex,
+    YANDEX_GEOCODER_URL
 )
-from redis_persistence import RedisPersistence
+from metrics import InstrumentedRequest, start_metrics_server, track
+from moltin_api import MOLTIN_API_URL, MoltinClient, MoltinTokenManager
+from moltin_cart import CartMirror
+from moltin_cache import (
+    CustomerCache,
+    FlowEntriesSnapshot,
+    MoltinCatalogCache
+)
+from profiler import ProfileReport, profile_event_loop
+from redis_persistence import RedisPersistence, close_redis, create_redis
+from resilience import CircuitBreaker, CircuitOpenError, RetryPolicy
+from serializers import Serializer
 from tg_lib import (
     send_cart_description,
     send_product_description,
+    send_product_card,
+    send_promo_menu,
+    parse_product,
+    get_enabled_promo,
     send_main_menu,
     send_delivery_option,
     send_payment_invoice,
@@ -50,6 +66,125 @@ from tg_lib import (
 
 logger = logging.getLogger(__file__)
 
+MAX_PROFILE_DURATION = 300
+
+
+class PizzaApplication(Application):
+
+    def __init__(self, moltin: MoltinClient,
+                 moltin_tokens: MoltinTokenManager,
+                 catalog: MoltinCatalogCache,
+                 restaurants: FlowEntriesSnapshot,
+                 geocoder: GeocodeCache, carts: CartMirror,
+                 customers: CustomerCache, tasks: BackgroundTaskQueue,
+                 redis: aioredis.Redis,
+                 metrics_address: Tuple[str, int] = None,
+                 admin_chat_ids: Iterable[int] = (),
+                 profile_duration: float = 30,
+                 profile_options: Dict[str, Any] = None, **kwargs):
+        super().__init__(**kwargs)
+        self.moltin = moltin
+        self.moltin_tokens = moltin_tokens
+        self.catalog = catalog
+        self.restaurants = restaurants
+        self.geocoder = geocoder
+        self.carts = carts
+        self.customers = customers
+        self.tasks = tasks
+        self.redis = redis
+        self.metrics_address = metrics_address
+        self.metrics_server: Optional[web.AppRunner] = None
+        self.admin_chat_ids = set(admin_chat_ids)
+        self.profile_duration = profile_duration
+        self.profile_options = profile_options or {}
+        self.profile_task: Optional[asyncio.Task] = None
+        if isinstance(self.persistence, RedisPersistence):
+            self.persistence.evict_callback = self.evict_data
+
+    def evict_data(self, data_name: str, entity_id: int) -> bool:
+        """Frees the data of an idle user or chat loaded by the persistence.
+
+        Data that is not handed to the persistence yet is kept.
+        """
+        if data_name == 'user_data':
+            if entity_id in self._user_ids_to_be_updated_in_persistence:
+                return False
+            self._user_data.pop(entity_id, None)
+        elif data_name == 'chat_data':
+            if entity_id in self._chat_ids_to_be_updated_in_persistence:
+                return False
+            self._chat_data.pop(entity_id, None)
+        return True
+
+    def start_profile(self, duration: float = None) -> Optional[asyncio.Task]:
+        if self.profile_task and not self.profile_task.done():
+            return None
+        self.profile_task = asyncio.create_task(profile_event_loop(
+            duration or self.profile_duration, **self.profile_options
+        ))
+        self.profile_task.add_done_callback(log_profile_error)
+        return self.profile_task
+
+    async def initialize(self) -> None:
+        await super().initialize()
+        await self.moltin_tokens.start()
+        await self.tasks.start()
+        if self.metrics_address and not self.metrics_server:
+            self.metrics_server = await start_metrics_server(
+                *self.metrics_address
+            )
+        with suppress(AttributeError, NotImplementedError):
+            asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1,
+                                                          self.start_profile)
+
+    async def shutdown(self) -> None:
+        await super().shutdown()
+        with suppress(AttributeError, NotImplementedError):
+            asyncio.get_running_loop().remove_signal_handler(signal.SIGUSR1)
+        if self.profile_task:
+            self.profile_task.cancel()
+        if self.metrics_server:
+            await self.metrics_server.cleanup()
+            self.metrics_server = None
+        await self.tasks.drain()
+        await self.customers.close()
+        await self.moltin_tokens.close()
+        await self.moltin.close()
+        await close_redis(self.redis)
+
+
+def log_profile_error(task: asyncio.Task) -> None:
+    if not task.cancelled() and (err := task.exception()):
+        logger.error(f'Не удалось снять профиль: {err}')
+
+
+async def send_profile_report(update: Update, task: asyncio.Task) -> None:
+    with suppress(asyncio.CancelledError):
+        report: ProfileReport = await task
+        await update.message.reply_text(
+            f'Сэмплов: {report.samples_count}, '
+            f'из них при заблокированном цикле: '
+            f'{report.blocked_samples_count}. '
+            f'Медленных колбэков: {len(report.slow_callbacks)}.'
+        )
+        for path in (report.stacks_path, report.report_path):
+            with open(path, 'rb') as report_file:
+                await update.message.reply_document(report_file,
+                                                    filename=path.name)
+
+
+async def handle_profile(update: Update,
+                         context: CallbackContext.DEFAULT_TYPE) -> None:
+    duration = context.application.profile_duration
+    with suppress(IndexError, ValueError):
+        duration = min(float(context.args[0]), MAX_PROFILE_DURATION)
+
+    if not (task := context.application.start_profile(duration)):
+        await update.message.reply_text('Профилирование уже запущено')
+        return
+    await update.message.reply_text(f'Профилирование запущено на {duration} с')
+    context.application.create_task(send_profile_report(update, task))
+
 
 async def handle_start(update: Update,
                        context: CallbackContext.DEFAULT_TYPE) -> str:
@@ -82,10 +217,14 @@ async def handle_menu(update: Update,
     chat_id = context.user_data['chat_id']
     message_id = context.user_data['message_id']
     user_reply = context.user_data['user_reply']
-    moltin_token = context.bot_data['moltin_token']
+    moltin = context.application.moltin
+    carts = context.application.carts
+    moltin_token = await context.application.moltin_tokens.get_token()
 
     if user_reply == 'cart':
-        user_cart = await get_cart_items(moltin_token, chat_id)
+        user_cart = await carts.get_items(
+            context.user_data, moltin_token, chat_id
+        )
         cart_description = parse_cart(user_cart)
         await send_cart_description(context, cart_description,
                                     chat_id, message_id)
@@ -96,36 +235,42 @@ async def handle_menu(update: Update,
         await send_main_menu(context, chat_id, message_id, page=page)
     elif user_reply.startswith('product_'):
         product_id = user_reply.replace('product_', '')
-        product = await get_product(moltin_token, product_id)
+        product_cards = context.bot_data.get('product_cards', {})
+        if product_card := product_cards.get(product_id):
+            await send_product_card(context, product_card,
+                                    chat_id, message_id)
+            return 'HANDLE_DESCRIPTION'
+
+        catalog = context.application.catalog
+        product = await catalog.get_product(moltin_token, product_id)
         product = product['data']
 
         categories_names = []
         if categories := product['relationships'].get('categories'):
             categories_id = [category['id'] for category in categories['data']]
-            categories = [await get_category(moltin_token, category_id) for
-                          category_id in categories_id]
+            categories = await asyncio.gather(*[
+                catalog.get_category(moltin_token, category_id)
+                for category_id in categories_id
+            ])
             categories_names = [category['data']['name'] for category in
                                 categories]
 
-        product_main_image = product['relationships'].get('main_image')
-        product_description = {
-            'id': product['id'],
-            'name': product['name'],
-            'description': product['description'],
-            'price': product['meta']['display_price']['with_tax']['formatted'],
-            'image_id': product_main_image['data']['id'] if product_main_image
-            else '',
-            'categories': categories_names
-        }
-
+        product_description = parse_product(product, categories_names)
         await send_product_description(context, product_description,
                                        chat_id, message_id)
         return 'HANDLE_DESCRIPTION'
     elif user_reply == 'promo':
-        promotions = await get_promotions(moltin_token)
-        promotions = promotions['data']
-        new_enabled_promo = [promo for promo in promotions
-                             if promo['enabled']][0]
+        if promo_menu := context.bot_data.get('promo_menu'):
+            await send_promo_menu(context, promo_menu, chat_id, message_id)
+            return 'HANDLE_MENU'
+
+        promotions = await moltin.get_promotions(moltin_token)
+        if not (new_enabled_promo := get_enabled_promo(promotions['data'])):
+            await context.bot.answer_callback_query(
+                callback_query_id=update.callback_query.id,
+                text='Сейчас акций нет'
+            )
+            return 'HANDLE_MENU'
         await send_promo_products(context, moltin_token, chat_id, message_id,
                                   new_enabled_promo)
 
@@ -136,7 +281,8 @@ async def handle_description(update: Update,
                              context: CallbackContext.DEFAULT_TYPE) -> str:
     chat_id = context.user_data['chat_id']
     message_id = context.user_data['message_id']
-    moltin_token = context.bot_data['moltin_token']
+    carts = context.application.carts
+    moltin_token = await context.application.moltin_tokens.get_token()
     user_reply = context.user_data['user_reply']
 
     if user_reply == 'menu':
@@ -145,11 +291,13 @@ async def handle_description(update: Update,
         return 'HANDLE_MENU'
     elif user_reply.startswith('add_'):
         product_id = user_reply.replace('add_', '')
-        user_cart = await get_or_create_cart(moltin_token, chat_id)
         try:
-            await add_cart_item(moltin_token, user_cart['data']['id'],
-                                product_id, item_quantity=1)
-        except requests.exceptions.HTTPError:
+            await carts.add_item(
+                context.user_data, moltin_token, chat_id, product_id,
+                item_quantity=1
+            )
+        except (aiohttp.ClientError, asyncio.TimeoutError,
+                CircuitOpenError):
             await context.bot.answer_callback_query(
                 callback_query_id=update.callback_query.id,
                 text='Не удалось добавить товар в корзину'
@@ -167,16 +315,18 @@ async def handle_cart(update: Update,
     chat_id = context.user_data['chat_id']
     message_id = context.user_data['message_id']
     user_reply = context.user_data['user_reply']
-    moltin_token = context.bot_data['moltin_token']
+    carts = context.application.carts
+    moltin_token = await context.application.moltin_tokens.get_token()
 
     if user_reply == 'menu':
         current_page = context.user_data['current_page']
         await send_main_menu(context, chat_id, message_id, page=current_page)
         return 'HANDLE_MENU'
     elif user_reply == 'pay':
-        customer = await get_customer_by_email(moltin_token,
-                                               context.user_data.get('email'))
-        if customer['data']:
+        customer = await context.application.customers.get_customer(
+            context.user_data, moltin_token, context.user_data.get('email')
+        )
+        if customer:
             await send_payment_option(context, chat_id, message_id)
             return 'HANDLE_PAYMENT_OPTION'
 
@@ -188,29 +338,32 @@ async def handle_cart(update: Update,
         return 'WAITING_EMAIL'
     elif user_reply.startswith('remove_'):
         product_id = user_reply.replace('remove_', '')
-        item_removed = await remove_cart_item(moltin_token, chat_id,
-                                              product_id)
-        if item_removed:
+        try:
+            user_cart = await carts.remove_item(
+                context.user_data, moltin_token, chat_id, product_id
+            )
+        except (aiohttp.ClientError, asyncio.TimeoutError,
+                CircuitOpenError):
             await context.bot.answer_callback_query(
                 callback_query_id=update.callback_query.id,
-                text='Товар удален из корзины'
+                text='Товар не может быть удален из корзины'
             )
-            user_cart = await get_cart_items(moltin_token, chat_id)
-            cart_description = parse_cart(user_cart)
-            await send_cart_description(context, cart_description,
-                                        chat_id, message_id)
         else:
             await context.bot.answer_callback_query(
                 callback_query_id=update.callback_query.id,
-                text='Товар не может быть удален из корзины'
+                text='Товар удален из корзины'
             )
+            cart_description = parse_cart(user_cart)
+            await send_cart_description(context, cart_description,
+                                        chat_id, message_id)
     return 'HANDLE_CART'
 
 
 async def handle_email(update: Update,
                        context: CallbackContext.DEFAULT_TYPE) -> str:
     user_email = context.user_data['user_reply']
-    moltin_token = context.bot_data['moltin_token']
+    customers = context.application.customers
+    moltin_token = await context.application.moltin_tokens.get_token()
 
     if not validate_email(user_email):
         message = 'Почта указана не верно. Отправьте почту еще раз.'
@@ -218,14 +371,13 @@ async def handle_email(update: Update,
         return 'WAITING_EMAIL'
 
     context.user_data['email'] = user_email
-    customer = await get_or_create_customer_by_email(moltin_token, user_email)
+    await customers.get_or_create_customer(context.user_data, moltin_token,
+                                           user_email)
 
-    message = f'''
-    Вы ввели эту почту: {user_email}
-
-    Пришлите нам ваш адрес текстом или геолокацию.'''
-    await update.message.reply_text(text=dedent(message))
-    return 'HANDLE_LOCATION'
+    await update.message.reply_text(text=f'Вы ввели эту почту: {user_email}')
+    await send_payment_option(context, context.user_data['chat_id'],
+                              context.user_data['message_id'])
+    return 'HANDLE_PAYMENT_OPTION'
 
 
 async def handle_payment_option(update: Update,
@@ -250,23 +402,23 @@ async def handle_payment_option(update: Update,
 async def handle_location(update: Update,
                           context: CallbackContext.DEFAULT_TYPE) -> str:
     user_location = context.user_data['user_reply']
-    moltin_token = context.bot_data['moltin_token']
 
     try:
         coordinates = user_location.longitude, user_location.latitude
     except AttributeError:
         yandex_api_key = context.bot_data['yandex_api_key']
-        coordinates = await fetch_coordinates(user_location, yandex_api_key)
+        coordinates = await context.application.geocoder.fetch_coordinates(
+            user_location, yandex_api_key
+        )
     if not coordinates:
         await update.message.reply_text(
             text='Не могу распознать этот адрес, повторите попытку.'
         )
         return 'HANDLE_LOCATION'
 
-    available_restaurants = await get_available_entries(moltin_token,
-                                                        flow_slug='Pizzeria')
+    restaurants_index = await context.application.restaurants.get_index()
     nearest_restaurant = get_nearest_restaurant(coordinates,
-                                                available_restaurants)
+                                                restaurants_index)
     context.user_data.update(
         {
             'nearest_restaurant': nearest_restaurant,
@@ -274,8 +426,9 @@ async def handle_location(update: Update,
         }
     )
     lon, lat = coordinates
-    await create_flow_entry(moltin_token, 'Customer-Address',
-                            {'Lon': lon, 'Lat': lat})
+    await context.application.tasks.submit('create_flow_entry',
+                                           'Customer-Address',
+                                           {'Lon': lon, 'Lat': lat})
     await send_delivery_option(update, nearest_restaurant)
     return 'HANDLE_DELIVERY'
 
@@ -285,9 +438,12 @@ async def handle_delivery(update: Update,
     chat_id = context.user_data['chat_id']
     message_id = context.user_data['message_id']
     user_reply = context.user_data['user_reply']
-    moltin_token = context.bot_data['moltin_token']
+    carts = context.application.carts
+    moltin_token = await context.application.moltin_tokens.get_token()
 
-    user_cart = await get_cart_items(moltin_token, chat_id)
+    user_cart = await carts.get_items(
+        context.user_data, moltin_token, chat_id
+    )
     cart_description = parse_cart(user_cart)
     context.user_data['cart_description'] = cart_description
     nearest_restaurant = context.user_data['nearest_restaurant']
@@ -341,7 +497,7 @@ async def handle_delivery(update: Update,
             await send_order_to_courier(context, chat_id, message_id,
                                         pay_option)
 
-        await delete_cart(moltin_token, chat_id)
+        await carts.delete(context.user_data, moltin_token, chat_id)
         unnecessary_data = ('nearest_restaurant', 'delivery_coordinates',
                             'cart_description', 'pay_option')
         clean_user_data(context.user_data, unnecessary_data)
@@ -382,10 +538,11 @@ async def successful_payment_callback(
         context: CallbackContext.DEFAULT_TYPE) -> None:
     chat_id = update.message.chat_id
     message_id = update.message.message_id
-    moltin_token = context.bot_data['moltin_token']
+    carts = context.application.carts
+    moltin_token = await context.application.moltin_tokens.get_token()
 
     await update.message.reply_text('Оплата прошла успешно')
-    await delete_cart(moltin_token, chat_id)
+    await carts.delete(context.user_data, moltin_token, chat_id)
 
     if context.user_data.get('delivery'):
         pay_option = context.user_data['pay_option']
@@ -417,25 +574,12 @@ async def handle_users_reply(update: Update,
         }
     )
 
-    if (not (token_expiration := context.bot_data.get('token_expiration')) or
-            token_expiration <= datetime.timestamp(datetime.now())):
-        moltin_access_token = await get_access_token(
-            context.bot_data['client_id'],
-            context.bot_data['client_secret']
-        )
-        context.bot_data.update(
-            {
-                'moltin_token': moltin_access_token['access_token'],
-                'token_expiration': moltin_access_token['expires'],
-            }
-        )
-
     if user_reply == '/start':
         user_state = 'START'
     elif user_reply == '/menu':
         user_state = 'MENU'
     else:
-        user_state = context.user_data['state']
+        user_state = context.user_data.get('state', 'START')
 
     states_functions = {
         'START': handle_start,
@@ -452,20 +596,21 @@ async def handle_users_reply(update: Update,
     state_handler = states_functions[user_state]
 
     try:
-        next_state = await state_handler(update, context)
+        with track('bot_handler', state=user_state):
+            next_state = await state_handler(update, context)
         context.user_data['state'] = next_state
+    except CircuitOpenError as err:
+        logger.error(err)
+        if query := update.callback_query:
+            with suppress(TelegramError):
+                await query.answer(
+                    text='Сервис временно недоступен, попробуйте позже'
+                )
     except Exception as err:
         logger.error(err)
 
 
-def main() -> None:
-    env = Env()
-    env.read_env()
-
-    logging.basicConfig(level=logging.INFO)
-
-    bot_token = env.str('TG_BOT_TOKEN')
-
+def build_application(env: Env, bot: Bot = None) -> PizzaApplication:
     client_id = env.str('CLIENT_ID')
     client_secret = env.str('CLIENT_SECRET')
     yandex_api_key = env.str('YANDEX_API_KEY')
@@ -473,10 +618,47 @@ def main() -> None:
 
     redis_uri = env.str('REDIS_URL')
 
+    moltin = MoltinClient(
+        base_url=env.str('MOLTIN_API_URL', MOLTIN_API_URL),
+        connections_limit=env.int('MOLTIN_CONNECTIONS_LIMIT', 100),
+        connections_limit_per_host=env.int('MOLTIN_CONNECTIONS_PER_HOST', 30),
+        keepalive_timeout=env.float('MOLTIN_KEEPALIVE_TIMEOUT', 30),
+        dns_cache_ttl=env.int('MOLTIN_DNS_CACHE_TTL', 300),
+        retry_policy=RetryPolicy(
+            max_attempts=env.int('MOLTIN_RETRY_ATTEMPTS', 3),
+            deadline=env.float('MOLTIN_REQUEST_DEADLINE', 10),
+        ),
+        circuit_breaker=CircuitBreaker(
+            'moltin',
+            failure_threshold=env.int('MOLTIN_BREAKER_THRESHOLD', 5),
+            recovery_timeout=env.float('MOLTIN_BREAKER_RECOVERY_TIMEOUT', 30),
+        ),
+    )
+    moltin_tokens = MoltinTokenManager(
+        moltin, client_id, client_secret,
+        refresh_margin=env.float('MOLTIN_TOKEN_REFRESH_MARGIN', 60)
+    )
+    catalog = MoltinCatalogCache(
+        moltin,
+        maxsize=env.int('CATALOG_CACHE_SIZE', 1024),
+        product_ttl=env.float('CATALOG_PRODUCT_TTL', 600),
+        category_ttl=env.float('CATALOG_CATEGORY_TTL', 3600),
+        categories_ttl=env.float('CATALOG_CATEGORY_TTL', 3600),
+        sku_ttl=env.float('CATALOG_PRODUCT_TTL', 600),
+    )
+    restaurants_refresh_interval = env.float('RESTAURANTS_REFRESH_INTERVAL',
+                                             600)
+    carts = CartMirror(moltin, ttl=env.float('CART_MIRROR_TTL', 300))
+    customers = CustomerCache(
+        moltin, moltin_tokens,
+        revalidate_after=env.float('CUSTOMER_REVALIDATE_AFTER', 3600)
+    )
+    restaurants = FlowEntriesSnapshot(moltin, moltin_tokens, 'Pizzeria',
+                                      ttl=restaurants_refresh_interval * 2,
+                                      index_factory=RestaurantsIndex)
+
     initial_db_data = {
         'bot_data': {
-            'client_id': client_id,
-            'client_secret': client_secret,
             'yandex_api_key': yandex_api_key,
             'provider_token': provider_token,
         }
@@ -490,14 +672,106 @@ def main() -> None:
         'chat_data_key': env.str('DB_CHAT_DATA_KEY', '_chat_data'),
         'conversations_key': env.str('DB_CONVERSATIONS_KEY', '_conversations')
     }
-    persistence = RedisPersistence(url=redis_uri, **redis_db_keys,
-                                   initial_data=initial_db_data)
-    application = Application.builder().token(bot_token).persistence(
+    redis = create_redis(
+        redis_uri,
+        max_connections=env.int('REDIS_MAX_CONNECTIONS', 50),
+        pool_timeout=env.float('REDIS_POOL_TIMEOUT', 5),
+        socket_timeout=env.float('REDIS_SOCKET_TIMEOUT', 5),
+        socket_connect_timeout=env.float('REDIS_SOCKET_CONNECT_TIMEOUT', 5),
+        health_check_interval=env.int('REDIS_HEALTH_CHECK_INTERVAL', 30),
+    )
+    persistence = RedisPersistence(
+        url=redis_uri, **redis_db_keys, initial_data=initial_db_data,
+        update_interval=env.float('PERSISTENCE_UPDATE_INTERVAL', 5),
+        flush_interval=env.float('PERSISTENCE_FLUSH_INTERVAL', 0.5),
+        flush_max_changes=env.int('PERSISTENCE_FLUSH_MAX_CHANGES', 500),
+        max_loaded_entries=env.int('PERSISTENCE_MAX_LOADED_ENTRIES', 10000),
+        idle_ttl=env.float('PERSISTENCE_IDLE_TTL', 3600),
+        storage_ttl=env.float('PERSISTENCE_STORAGE_TTL', 7 * 24 * 3600),
+        persistent_keys=env.list('PERSISTENCE_PERSISTENT_KEYS',
+                                 ['email', 'customer']),
+        listen_bot_data_updates=True,
+        redis=redis,
+        serializer=Serializer(
+            codec=env.str('PERSISTENCE_CODEC', 'msgpack'),
+            compression_threshold=env.int('PERSISTENCE_COMPRESSION_THRESHOLD',
+                                          1024),
+        ),
+    )
+    geocoder = GeocodeCache(
+        redis=redis,
+        key_prefix=f'{redis_db_keys["main_key"]}:geocode',
+        maxsize=env.int('GEOCODE_CACHE_SIZE', 10000),
+        ttl=env.int('GEOCODE_CACHE_TTL', 30 * 24 * 3600),
+        negative_ttl=env.int('GEOCODE_NEGATIVE_TTL', 600),
+        geocoder_url=env.str('YANDEX_GEOCODER_URL', YANDEX_GEOCODER_URL),
+    )
+
+    async def create_flow_entry(flow_slug: str,
+                                fields: Dict[str, Any]) -> None:
+        moltin_token = await moltin_tokens.get_token()
+        await moltin.create_flow_entry(moltin_token, flow_slug, fields)
+
+    tasks = BackgroundTaskQueue(
+        maxsize=env.int('TASK_QUEUE_SIZE', 1000),
+        workers=env.int('TASK_QUEUE_WORKERS', 4),
+        max_attempts=env.int('TASK_MAX_ATTEMPTS', 3),
+        redis=redis if env.bool('TASK_QUEUE_DURABLE', True) else None,
+        key_prefix=f'{redis_db_keys["main_key"]}:tasks',
+    )
+    tasks.register('create_flow_entry', create_flow_entry)
+    metrics_address = None
+    if metrics_port := env.int('METRICS_PORT', None):
+        metrics_address = env.str('METRICS_HOST', '127.0.0.1'), metrics_port
+
+    profile_options = {
+        'output_dir': Path(env.str('PROFILE_DIR', 'profiles')),
+        'interval': env.float('PROFILE_INTERVAL', 0.005),
+        'slow_callback_duration': env.float('PROFILE_SLOW_CALLBACK_DURATION',
+                                            0.1),
+    }
+
+    application_builder = Application.builder()
+    if bot:
+        application_builder.bot(bot)
+    else:
+        application_builder.token(env.str('TG_BOT_TOKEN')).request(
+            InstrumentedRequest(connection_pool_size=128)
+        )
+    application = application_builder.persistence(
         persistence
+    ).application_class(
+        PizzaApplication,
+        kwargs={
+            'moltin': moltin,
+            'moltin_tokens': moltin_tokens,
+            'catalog': catalog,
+            'restaurants': restaurants,
+            'geocoder': geocoder,
+            'carts': carts,
+            'customers': customers,
+            'tasks': tasks,
+            'redis': redis,
+            'metrics_address': metrics_address,
+            'admin_chat_ids': env.list('ADMIN_CHAT_IDS', [], subcast=int),
+            'profile_duration': env.float('PROFILE_DURATION', 30),
+            'profile_options': profile_options,
+        }
     ).build()
 
-    logger.info('Бот запущен')  # TODO: Отправлять логи в спец бот.
+    application.job_queue.run_repeating(restaurants.refresh_job,
+                                        interval=restaurants_refresh_interval,
+                                        first=0)
+    application.job_queue.run_repeating(
+        persistence.sweep_job,
+        interval=env.float('PERSISTENCE_SWEEP_INTERVAL', 300)
+    )
 
+    application.add_handler(
+        CommandHandler('profile', handle_profile, filters=filters.Chat(
+            application.admin_chat_ids
+        ))
+    )
     application.add_handler(
         CallbackQueryHandler(handle_users_reply)
     )
@@ -510,6 +784,17 @@ def main() -> None:
     application.add_handler(
         MessageHandler(filters.SUCCESSFUL_PAYMENT,
                        successful_payment_callback))
+    return application
+
+
+def main() -> None:
+    env = Env()
+    env.read_env()
+
+    logging.basicConfig(level=logging.INFO)
+
+    application = build_application(env)
+    logger.info('Бот запущен')  # TODO: Отправлять логи в спец бот.
 
     try:
         application.run_polling()
@@ -1,18 +1,16 @@
+import zlib
 from textwrap import dedent
-from typing import Union, Dict, Tuple, Any, List
+from typing import Union, Dict, Tuple, Any, List, Optional
 
 from telegram import (
     InlineKeyboardButton,
     InlineKeyboardMarkup, Update, LabeledPrice
 )
 from telegram.constants import ParseMode
+from telegram.error import BadRequest
 from telegram.ext import CallbackContext
 from telegram.helpers import escape_markdown
 
-from moltin_api import (
-    get_product_main_image_url, get_product_by_sku
-)
-
 DATA = ''
 
 
@@ -81,9 +79,22 @@ async def send_cart_description(context: CallbackContext.DEFAULT_TYPE,
                                      message_id=message_id)
 
 
-async def send_product_description(context: CallbackContext.DEFAULT_TYPE,
-                                   product_description: Dict[str, str],
-                                   chat_id: str, message_id: str) -> None:
+def parse_product(product: Dict[str, Any],
+                  categories_names: List[str]) -> Dict[str, Any]:
+    product_main_image = product['relationships'].get('main_image')
+    return {
+        'id': product['id'],
+        'name': product['name'],
+        'description': product['description'],
+        'price': product['meta']['display_price']['with_tax']['formatted'],
+        'image_id': product_main_image['data']['id'] if product_main_image
+        else '',
+        'categories': categories_names
+    }
+
+
+def get_product_card(product_description: Dict[str, Any],
+                     image_url: str = '') -> Dict[str, Any]:
     if len(categories := product_description['categories']) > 1:
         categories = [category.replace("'", "") for category in categories]
         categories_description = f'*Категории:* {", ".join(categories)}'
@@ -118,33 +129,76 @@ async def send_product_description(context: CallbackContext.DEFAULT_TYPE,
             [InlineKeyboardButton(text='В меню', callback_data='menu')]
         ]
     )
+    return {
+        'id': product_description['id'],
+        'text': dedent(message),
+        'reply_markup': reply_markup,
+        'image_id': product_description['image_id'],
+        'image_url': image_url,
+        'categories': product_description['categories'],
+    }
 
-    if image_id := product_description['image_id']:
-        await context.bot.send_chat_action(chat_id=chat_id,
-                                           action='typing')
 
-        moltin_token = context.bot_data['moltin_token']
-        img_url = await get_product_main_image_url(moltin_token, image_id)
+def get_photo_key(image_id: str, image_url: str) -> str:
+    image_version = zlib.crc32(image_url.encode())
+    return f'{image_id}:{image_version:08x}'
 
-        await context.bot.send_photo(chat_id=chat_id,
-                                     photo=img_url,
-                                     caption=dedent(message),
-                                     reply_markup=reply_markup,
-                                     parse_mode=ParseMode.MARKDOWN_V2)
+
+async def send_product_card(context: CallbackContext.DEFAULT_TYPE,
+                            product_card: Dict[str, Any],
+                            chat_id: str, message_id: str) -> None:
+    if img_url := product_card['image_url']:
+        photo_key = get_photo_key(product_card['image_id'], img_url)
+        photo_file_ids = context.bot_data.setdefault('photo_file_ids', {})
+        photo_params = {
+            'chat_id': chat_id,
+            'caption': product_card['text'],
+            'reply_markup': product_card['reply_markup'],
+            'parse_mode': ParseMode.MARKDOWN_V2,
+        }
+        try:
+            message = await context.bot.send_photo(
+                photo=photo_file_ids.get(photo_key, img_url), **photo_params
+            )
+        except BadRequest:
+            if not photo_file_ids.pop(photo_key, None):
+                raise
+            message = await context.bot.send_photo(photo=img_url,
+                                                   **photo_params)
+        if photo_key not in photo_file_ids:
+            photo_file_ids[photo_key] = message.photo[-1].file_id
         await context.bot.delete_message(chat_id=chat_id,
                                          message_id=message_id)
     else:
-        await context.bot.edit_message_text(text=dedent(message),
-                                            chat_id=chat_id,
-                                            message_id=message_id,
-                                            reply_markup=reply_markup,
-                                            parse_mode=ParseMode.MARKDOWN_V2)
+        await context.bot.edit_message_text(
+            text=product_card['text'],
+            chat_id=chat_id,
+            message_id=message_id,
+            reply_markup=product_card['reply_markup'],
+            parse_mode=ParseMode.MARKDOWN_V2
+        )
+
+
+async def send_product_description(context: CallbackContext.DEFAULT_TYPE,
+                                   product_description: Dict[str, str],
+                                   chat_id: str, message_id: str) -> None:
+    img_url = ''
+    if image_id := product_description['image_id']:
+        await context.bot.send_chat_action(chat_id=chat_id,
+                                           action='typing')
+
+        moltin = context.application.moltin
+        moltin_token = await context.application.moltin_tokens.get_token()
+        img_url = await moltin.get_product_main_image_url(moltin_token,
+                                                          image_id)
+
+    product_card = get_product_card(product_description, img_url)
+    await send_product_card(context, product_card, chat_id, message_id)
 
 
 def get_promo_menu(products: List[Dict[str, Any]]) -> InlineKeyboardMarkup:
     parsed_products = {
-        product['data'][0]['name']: product['data'][0]['id']
-        for product in products
+        product['name']: product['id'] for product in products
     }
     keyboard = []
     for product_name, product_id in parsed_products.items():
@@ -161,20 +215,39 @@ def get_promo_menu(products: List[Dict[str, Any]]) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(keyboard)
 
 
+def get_enabled_promo(
+        promotions: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    enabled_promotions = [promo for promo in promotions if promo['enabled']]
+    return enabled_promotions[0] if enabled_promotions else None
+
+
+def get_promo_products_sku(promo: Dict[str, Any]) -> List[str]:
+    return promo['schema']['exclude']['targets']
+
+
+async def send_promo_menu(context: CallbackContext.DEFAULT_TYPE,
+                          promo_menu: Dict[str, Any],
+                          chat_id: str, message_id: str) -> None:
+    await context.bot.send_message(text=promo_menu['description'],
+                                   chat_id=chat_id,
+                                   reply_markup=promo_menu['menu'])
+    await context.bot.delete_message(chat_id=chat_id,
+                                     message_id=message_id)
+
+
 async def send_promo_products(context: CallbackContext.DEFAULT_TYPE,
                               moltin_token: str,
                               chat_id: str, message_id: str,
                               promo: Dict[str, Any]) -> None:
-    promo_description = promo['description']
-    products_sku = promo['schema']['exclude']['targets']
-    products = [await get_product_by_sku(moltin_token, product_sku) for
-                product_sku in products_sku]
-    menu = get_promo_menu(products)
-    await context.bot.send_message(text=promo_description,
-                                   chat_id=chat_id,
-                                   reply_markup=menu)
-    await context.bot.delete_message(chat_id=chat_id,
-                                     message_id=message_id)
+    catalog = context.application.catalog
+    products = await catalog.get_products_by_skus(
+        moltin_token, get_promo_products_sku(promo)
+    )
+    promo_menu = {
+        'description': promo['description'],
+        'menu': get_promo_menu(products),
+    }
+    await send_promo_menu(context, promo_menu, chat_id, message_id)
 
 
 async def send_payment_option(context: CallbackContext.DEFAULT_TYPE,
@@ -1,16 +1,25 @@
 import asyncio
 import logging
-import pickle
-from collections import defaultdict
-from typing import Dict, Any
+from typing import Dict, Any, List, Union, Optional
 
 import aioredis
 import aioschedule
 from environs import Env
 from more_itertools import chunked
-from telegram import InlineKeyboardMarkup, InlineKeyboardButton
-
-from moltin_api import get_access_token, get_products
+from telegram import Bot, InlineKeyboardMarkup, InlineKeyboardButton
+from telegram.error import TelegramError
+
+from moltin_api import MOLTIN_API_URL, MoltinClient, MoltinTokenManager
+from redis_persistence import close_redis, create_redis, publish_bot_data
+from serializers import Serializer
+from tg_lib import (
+    get_product_card,
+    get_photo_key,
+    parse_product,
+    get_enabled_promo,
+    get_promo_menu,
+    get_promo_products_sku
+)
 
 logger = logging.getLogger(__file__)
 
@@ -48,10 +57,9 @@ def get_products_menu(products: list, page: int) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(keyboard)
 
 
-async def create_menu(moltin_token: str,
-                      products_per_page: int) -> Dict[int, Any]:
-    products = await get_products(moltin_token)
-    products_per_page = list(chunked(products['data'], products_per_page))
+def create_menu(products: List[Dict[str, Any]],
+                products_per_page: int) -> Dict[int, Any]:
+    products_per_page = list(chunked(products, products_per_page))
     menu = {}
     for page in range(1, len(products_per_page) + 1):
         menu_per_page = get_products_menu(products_per_page, page)
@@ -59,35 +67,132 @@ async def create_menu(moltin_token: str,
     return menu
 
 
-async def cache_menu(moltin_token: str, redis_url: str,
-                     db_keys: Dict[str, str],
-                     products_per_page: int = 8) -> None:
-    redis_connection = aioredis.from_url(redis_url)
-    menu = await create_menu(moltin_token, products_per_page)
-
-    db_contents_bytes = await redis_connection.get(db_keys['db_main_key'])
-    if db_contents_bytes:
-        db_contents = pickle.loads(db_contents_bytes)
-    else:
-        db_contents = {
-            db_keys['bot_data_key']: {},
-            db_keys['callback_data_key']: ([], {}),
-            db_keys['chat_data_key']: defaultdict(dict, {}),
-            db_keys['conversations_key']: {},
-            db_keys['user_data_key']: defaultdict(dict, {})
-        }
-    db_contents[db_keys['bot_data_key']].update({
-        'menu': menu
-    })
-    db_contents_bytes = pickle.dumps(db_contents)
-    menu_updated = await redis_connection.set(db_keys['db_main_key'],
-                                              db_contents_bytes)
-    if menu_updated:
-        logger.info('Меню успешно обновлено')
-
-
-async def job(moltin_token, redis_uri, db_main_key, bot_data_key):
-    await cache_menu(moltin_token, redis_uri, db_main_key, bot_data_key)
+async def create_product_cards(
+        moltin: MoltinClient, moltin_token: str,
+        products: Dict[str, Any],
+        categories: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    images_urls = {
+        image['id']: image['link']['href']
+        for image in products.get('included', {}).get('main_images', [])
+    }
+    categories_names = {
+        category['id']: category['name'] for category in categories
+    }
+
+    products_descriptions = []
+    for product in products['data']:
+        product_categories_names = []
+        if product_categories := product['relationships'].get('categories'):
+            product_categories_names = [
+                categories_names[category['id']]
+                for category in product_categories['data']
+                if category['id'] in categories_names
+            ]
+        products_descriptions.append(
+            parse_product(product, product_categories_names)
+        )
+
+    missing_images_ids = {
+        product_description['image_id']
+        for product_description in products_descriptions
+        if product_description['image_id']
+        and product_description['image_id'] not in images_urls
+    }
+    missing_images_urls = await asyncio.gather(*[
+        moltin.get_product_main_image_url(moltin_token, image_id)
+        for image_id in missing_images_ids
+    ])
+    images_urls.update(zip(missing_images_ids, missing_images_urls))
+
+    return {
+        product_description['id']: get_product_card(
+            product_description,
+            images_urls.get(product_description['image_id'], '')
+        )
+        for product_description in products_descriptions
+    }
+
+
+async def create_promo_menu(moltin: MoltinClient,
+                            moltin_token: str) -> Optional[Dict[str, Any]]:
+    promotions = await moltin.get_promotions(moltin_token)
+    if not (promo := get_enabled_promo(promotions['data'])):
+        return None
+    products = await moltin.get_products_by_skus(
+        moltin_token, get_promo_products_sku(promo)
+    )
+    return {
+        'description': promo['description'],
+        'menu': get_promo_menu(products),
+    }
+
+
+async def warm_up_photos(bot: Bot, chat_id: Union[int, str],
+                         product_cards: Dict[str, Dict[str, Any]],
+                         photo_file_ids: Dict[str, str]) -> int:
+    uploaded_photos = 0
+    for product_card in product_cards.values():
+        if not (img_url := product_card['image_url']):
+            continue
+        photo_key = get_photo_key(product_card['image_id'], img_url)
+        if photo_key in photo_file_ids:
+            continue
+        try:
+            message = await bot.send_photo(chat_id=chat_id, photo=img_url,
+                                           disable_notification=True)
+        except TelegramError as err:
+            logger.error(f'Не удалось загрузить фото {img_url}: {err}')
+            continue
+        photo_file_ids[photo_key] = message.photo[-1].file_id
+        await bot.delete_message(chat_id=chat_id,
+                                 message_id=message.message_id)
+        uploaded_photos += 1
+    return uploaded_photos
+
+
+async def cache_menu(moltin: MoltinClient, moltin_token: str,
+                     redis: aioredis.Redis, db_keys: Dict[str, str],
+                     serializer: Serializer, products_per_page: int = 8,
+                     bot: Bot = None,
+                     warmup_chat_id: Union[int, str] = None) -> None:
+    products, categories, promo_menu = await asyncio.gather(
+        moltin.get_products(moltin_token, include='main_image'),
+        moltin.get_categories(moltin_token),
+        create_promo_menu(moltin, moltin_token)
+    )
+    menu = create_menu(products['data'], products_per_page)
+    product_cards = await create_product_cards(moltin, moltin_token,
+                                               products, categories['data'])
+
+    bot_data_key = f"{db_keys['db_main_key']}:{db_keys['bot_data_key']}"
+    bot_data = {
+        'menu': menu,
+        'product_cards': product_cards,
+        'promo_menu': promo_menu,
+    }
+    if bot and warmup_chat_id:
+        photo_file_ids_bytes = await redis.hget(bot_data_key,
+                                                'photo_file_ids')
+        photo_file_ids = (serializer.loads(photo_file_ids_bytes)
+                          if photo_file_ids_bytes else {})
+        if uploaded_photos := await warm_up_photos(bot, warmup_chat_id,
+                                                   product_cards,
+                                                   photo_file_ids):
+            logger.info(f'Загружено фото товаров: {uploaded_photos}')
+            bot_data['photo_file_ids'] = photo_file_ids
+    version = await publish_bot_data(
+        redis, db_keys['db_main_key'], db_keys['bot_data_key'],
+        {field: serializer.dumps(value) for field, value in bot_data.items()}
+    )
+    if version:
+        logger.info(f'Меню успешно обновлено, версия {version}')
+
+
+async def job(moltin, moltin_tokens, redis, db_keys, serializer, bot=None,
+              warmup_chat_id=None):
+    moltin_token = await moltin_tokens.get_token()
+    await cache_menu(moltin, moltin_token, redis, db_keys, serializer,
+                     bot=bot, warmup_chat_id=warmup_chat_id)
 
 
 async def main():
@@ -98,30 +203,51 @@ async def main():
     redis_uri = env.str('REDIS_URL')
     client_id = env.str('CLIENT_ID')
     client_secret = env.str('CLIENT_SECRET')
+    moltin_api_url = env.str('MOLTIN_API_URL', MOLTIN_API_URL)
 
     db_keys = {
         'db_main_key': env.str('DB_MAIN_KEY', 'tg'),
         'bot_data_key': env.str('DB_BOT_DATA_KEY', '_bot_data'),
-        'user_data_key': env.str('DB_USER_DATA_KEY', '_user_data'),
-        'chat_data_key': env.str('_chat_data', '_chat_data'),
-        'callback_data_key': env.str('DB_CALLBACK_DATA_KEY', '_callback_data'),
-        'conversations_key': env.str('DB_CONVERSATIONS_KEY', '_conversations'),
     }
 
-    moltin_access_token = await get_access_token(client_id, client_secret)
-    moltin_token = moltin_access_token['access_token']
-
-    prefix = 'redis://'
-    if not redis_uri.startswith(prefix):
-        redis_uri = f'{prefix}{redis_uri}'
-
-    await cache_menu(moltin_token, redis_uri, db_keys)
-
-    aioschedule.every(10).seconds.do(job, moltin_token, redis_uri, db_keys)
+    redis = create_redis(
+        redis_uri,
+        max_connections=env.int('REDIS_MAX_CONNECTIONS', 50),
+        pool_timeout=env.float('REDIS_POOL_TIMEOUT', 5),
+        socket_timeout=env.float('REDIS_SOCKET_TIMEOUT', 5),
+        socket_connect_timeout=env.float('REDIS_SOCKET_CONNECT_TIMEOUT', 5),
+        health_check_interval=env.int('REDIS_HEALTH_CHECK_INTERVAL', 30),
+    )
+    serializer = Serializer(
+        codec=env.str('PERSISTENCE_CODEC', 'msgpack'),
+        compression_threshold=env.int('PERSISTENCE_COMPRESSION_THRESHOLD',
+                                      1024),
+    )
 
-    while True:
-        await aioschedule.run_pending()
-        await asyncio.sleep(1)
+    bot = None
+    if warmup_chat_id := env.int('PHOTO_WARMUP_CHAT_ID', None):
+        bot = Bot(env.str('TG_BOT_TOKEN'))
+        await bot.initialize()
+
+    async with MoltinClient(base_url=moltin_api_url) as moltin:
+        moltin_tokens = MoltinTokenManager(moltin, client_id, client_secret)
+        await moltin_tokens.start()
+        try:
+            await job(moltin, moltin_tokens, redis, db_keys, serializer,
+                      bot, warmup_chat_id)
+
+            aioschedule.every(10).seconds.do(job, moltin, moltin_tokens,
+                                             redis, db_keys, serializer, bot,
+                                             warmup_chat_id)
+
+            while True:
+                await aioschedule.run_pending()
+                await asyncio.sleep(1)
+        finally:
+            await moltin_tokens.close()
+            await close_redis(redis)
+            if bot:
+                await bot.shutdown()
 
 
 if __name__ == '__main__':